@@ -1,17 +1,25 @@
 import sys
 import socket
-import pickle
-import base64
-from threading import Thread
+import time
+from threading import Lock, Thread
 from queue import SimpleQueue
 from datetime import datetime
+from codec import decode, encode
+import compression
+from batching import EXIT, SendStats, drain, no_delay
+import handshake
+from drawing_store import drawing_id
+from image_pipeline import ImagePipeline
+from protocol import FrameBuffer, pack_frame, recv_frames
+from strokes import StrokeLog, iter_segments
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, pyqtSlot, pyqtSignal, QObject
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLineEdit, QTextEdit, \
+from PyQt5.QtWidgets import QApplication, QMainWindow, QLineEdit, QPlainTextEdit, \
 QPushButton, QWidget, QGridLayout, QHBoxLayout, QLabel, QInputDialog, QMessageBox
 
 class Communication(QObject):
     msg_signal = pyqtSignal(dict)
+    inbox_signal = pyqtSignal()  # SocketCommunication.inbox got messages, sent once until they are taken
 
 class SocketCommunication(QObject):
 
@@ -23,26 +31,30 @@ class SocketCommunication(QObject):
         self.running = False
         self.send_thread = None
         self.receive_thread = None
+        self.frames = FrameBuffer()
+        self.compression = None  # what the server agreed on in the handshake
+        self.stats = SendStats()  # batches, packets and queue latency of the send thread
+        self.inbox = []  # decoded messages the gui hasn't taken yet
+        self.inbox_lock = Lock()
         self.current_room = None
 
     def connect(self):
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect(('127.0.0.1', 9003))
+            no_delay(self.sock)
             print("Connected to server")
             
             # name request in a separate window 
             name, ok = QInputDialog.getText(None, "Name", "Enter your name:")
-            if ok and name:
-                self.sock.send(name.encode('utf-8'))
-            else:
-                self.sock.send("Anonymous".encode('utf-8'))
+            if not (ok and name):
+                name = "Anonymous"
+            #hello with the name, the server answers with the features we can use (handshake.py)
+            self.compression, messages = handshake.connect(self.sock, name, self.frames)
             
-            # greetings!!
-            data = self.sock.recv(1024)
-            #converts a byte string representing a serialized object back to the original object in memory
-            welcome_msg = pickle.loads(data)
-            self.comm.msg_signal.emit(welcome_msg)
+            # greetings!! (may arrive together with the answer)
+            for message in messages:
+                self.comm.msg_signal.emit(message)
             
             # threads execution
             self.running = True
@@ -63,53 +75,94 @@ class SocketCommunication(QObject):
     def receive_messages(self):
         while self.running:
             try:
-                data = self.sock.recv(65536)
-                if not data:
+                frames = recv_frames(self.sock, self.frames)
+                if not frames:
                     break
-                #converts a byte string representing a serialized object back to the original object in memory
-                message = pickle.loads(data)
-
-                # emit() generates a signal for data tranferring to the main thread
-                self.comm.msg_signal.emit(message)
+                messages = [decode(frame) for frame in frames]
+
+                #one signal for everything that comes before the gui takes it (not one per message)
+                with self.inbox_lock:
+                    wake = not self.inbox
+                    self.inbox.extend(messages)
+                if wake:
+                    self.comm.inbox_signal.emit()
             except Exception as e:
                 #if didnt break yet throwing mistakes
                 if self.running:
                     print(f"Receive error: {e}")
                 break
 
+    def take_messages(self):
+        with self.inbox_lock:
+            messages, self.inbox = self.inbox, []
+        return messages
+
     def send_messages(self):
         while self.running:
             try:
-                message = self.queue.get()
-                if message == "EXIT":
+                item = self.queue.get()
+                if item == EXIT:
+                    break
+                #everything queued since the last write goes out together
+                batch, stop = drain(self.queue, item)
+                data = b''.join(frame for frame, _ in batch)
+                self.sock.sendall(data)
+                self.stats.record(batch, len(data), time.perf_counter())
+                if stop:
                     break
-                #returns a serialized representation of an object as a sequence of bytes
-                self.sock.send(pickle.dumps(message))
             except Exception as e:
                 print(f"Send error: {e}")
                 break
 
     def send_message(self, message_type, data):
         if self.running:
-            message = {'type': message_type, 'data': data}
-            self.queue.put(message)
+            #framed here so the send thread only has to join and write
+            payload = encode({'type': message_type, 'data': data})
+            if self.compression and message_type not in compression.PRECOMPRESSED_TYPES:
+                payload = compression.compress(payload, self.compression)
+            self.queue.put((pack_frame(payload), time.perf_counter()))
 
     def disconnect(self):
         self.running = False
-        self.queue.put("EXIT")
+        self.queue.put(EXIT)
+        print(f"Sent: {self.stats.summary()}")
         try:
             if self.sock:
                 self.sock.close()
         except:
             pass
 
+PEN_WIDTH = 4
+STROKE_INTERVAL = 100  # ms between two stroke batches
+FRAME_INTERVAL = 16  # ms, the canvas is repainted at most once per frame (~60 fps)
+CHAT_LINES = 1000  # the chat keeps the last lines only, older ones are dropped
+
+def draw_strokes(pixmap, data):
+    #replays a stroke batch (see strokes.py) on a pixmap
+    painter = QtGui.QPainter(pixmap)
+    p = painter.pen()
+    for x1, y1, x2, y2, color, width in iter_segments(data):
+        p.setWidth(width)
+        p.setColor(QtGui.QColor(color))
+        painter.setPen(p)
+        painter.drawLine(x1, y1, x2, y2)
+    painter.end()
+
 #the whole gui class :)
 class Canvas(QtWidgets.QLabel):
     def __init__(self):
         super().__init__()
+        #mouse moves are only collected, once per frame they are painted with one QPainter
+        #and only the rectangle around them is repainted (not the whole canvas)
+        self.pending = []  # (x1, y1, x2, y2, color) not painted yet
+        self.dirty = QtCore.QRect()
+        self.frame_timer = QtCore.QTimer()
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.timeout.connect(self.flush)
         self.setup_canvas()
         self.current_color = '#000000'
         self.last_x, self.last_y = None, None
+        self.stroke_log = StrokeLog()  # segments drawn since the last batch was sent
     
     def setup_canvas(self):
         pixmap = QtGui.QPixmap(600, 600)
@@ -128,14 +181,12 @@ class Canvas(QtWidgets.QLabel):
             self.last_y = event.y()
             return 
         
-        painter = QtGui.QPainter(self.pixmap())
-        p = painter.pen()
-        p.setWidth(4)
-        p.setColor(QtGui.QColor(self.current_color))
-        painter.setPen(p)
-        painter.drawLine(self.last_x, self.last_y, event.x(), event.y())
-        painter.end()
-        self.update()
+        self.pending.append((self.last_x, self.last_y, event.x(), event.y(), self.current_color))
+        segment = QtCore.QRect(QtCore.QPoint(self.last_x, self.last_y), event.pos()).normalized()
+        self.dirty = self.dirty.united(segment.adjusted(-PEN_WIDTH, -PEN_WIDTH, PEN_WIDTH, PEN_WIDTH))
+        if not self.frame_timer.isActive():
+            self.frame_timer.start(FRAME_INTERVAL)
+        self.stroke_log.add_segment(self.last_x, self.last_y, event.x(), event.y(), self.current_color, PEN_WIDTH)
 
         #actually, the line is a set of close-standing points.
         # to make line unbreakable, we will draw a new point where the previous finishes
@@ -147,29 +198,44 @@ class Canvas(QtWidgets.QLabel):
         self.last_x = None
         self.last_y = None
 
-    def to_base64(self):
-        #function converts QPixmap into base64
-        #Base64 is a system for encoding binary data into a text format using only 64 ASCII characters!
-        try:
-            qimage = self.pixmap().toImage()
-            buffer = QtCore.QBuffer()
-            buffer.open(QtCore.QIODevice.ReadWrite)
-            qimage.save(buffer, "PNG")
-            data = buffer.data()
-            return base64.b64encode(data).decode('utf-8')
-        except Exception as e:
-            print(f"Error converting to base64: {e}")
-            return ""
+    def flush(self):
+        #paints the collected segments and repaints only the dirty rectangle
+        self.frame_timer.stop()
+        if not self.pending:
+            return
+        painter = QtGui.QPainter(super().pixmap())
+        p = painter.pen()
+        p.setWidth(PEN_WIDTH)
+        color = None
+        for x1, y1, x2, y2, segment_color in self.pending:
+            if segment_color != color:
+                color = segment_color
+                p.setColor(QtGui.QColor(color))
+                painter.setPen(p)
+            painter.drawLine(x1, y1, x2, y2)
+        painter.end()
+        self.pending = []
+        self.update(self.dirty)
+        self.dirty = QtCore.QRect()
 
-    def from_base64(self, base64_string):
-        #loads base64 to QPixmap
-        try:
-            image_data = base64.b64decode(base64_string)
-            pixmap = QtGui.QPixmap()
-            pixmap.loadFromData(image_data)
-            self.setPixmap(pixmap)
-        except Exception as e:
-            print(f"Error loading from base64: {e}")
+    def pixmap(self):
+        #whoever reads the canvas also gets the segments that are still waiting for the next frame
+        self.flush()
+        return super().pixmap()
+
+    def setPixmap(self, pixmap):
+        #waiting segments belong to the old canvas
+        self.flush()
+        super().setPixmap(pixmap)
+
+    def to_image(self):
+        #a copy of the canvas the png workers can use (QPixmap only works on the gui thread)
+        #the png bytes go to the server as they are, no base64 (it made every drawing 33% bigger)
+        return self.pixmap().toImage()
+
+    def set_image(self, image):
+        #swaps in a canvas that the workers already decoded
+        self.setPixmap(QtGui.QPixmap.fromImage(image))
 
 colors = ['#000000', '#141923', '#414168', '#3a7fa7', '#35e3e3', '#8fd970', '#5ebb49',
 '#458352', '#dcd37b', '#fffee5', '#ffd035', '#cc9245', '#a15c3e', '#a42f3b',
@@ -190,10 +256,33 @@ class MainWindow(QtWidgets.QMainWindow):
         self.canvas = Canvas()
         
         self.sock_comm = SocketCommunication(self.comm)
+        self.images = ImagePipeline()  # tiles and png decoding off the gui thread
+        #tile sync: only the tiles that changed since a drawing the server also has go out
+        self.tile_base = None  # (drawing id, tile hashes) of that drawing, None = white canvas
+        self.pending_upload = None  # (base id, tile hashes, canvas) of the upload waiting for tiles_ack
         
+        #inbound messages are handled once per frame and their chat lines go in with one
+        #document edit, a busy chat doesn't flood the event queue or relayout for every line
+        self.pending_lines = []  # html lines not in the chat yet
+        self.inbox_timer = QtCore.QTimer()
+        self.inbox_timer.setSingleShot(True)
+        self.inbox_timer.timeout.connect(self.process_inbox)
+
         self.swap_timer = QtCore.QTimer()
         self.swap_timer.timeout.connect(self.send_current_drawing)
         self.swap_timer_running = False
+
+        #stroke deltas: the strokes go out every 100 ms, so the other player can watch
+        #and an exchange only needs the strokes of the round instead of a whole png
+        self.stroke_timer = QtCore.QTimer()
+        self.stroke_timer.timeout.connect(self.send_strokes)
+        self.stroke_timer.start(STROKE_INTERVAL)
+        self.round = 0
+        self.round_base = None  # my canvas when the round started
+        self.sent_batches = []  # my stroke batches of this round
+        self.uploads = {}  # drawing_id of my last pngs -> my canvas at that moment
+        self.last_given = None  # the canvas the other player got from me, it is what they draw on now
+        self.spectate_pixmap = None
         
         self.set_gui()  
         
@@ -222,12 +311,22 @@ class MainWindow(QtWidgets.QMainWindow):
         self.btn_send.setText("send")
         self.btn_send.clicked.connect(self.event_send)
         self.comm.msg_signal.connect(self.event_recv)
+        self.comm.inbox_signal.connect(self.schedule_inbox)
 
-        self.output_area = QTextEdit()
+        #plain text layout only lays out the lines on screen, and with a maximum block count the
+        #oldest line goes when a new one comes: appending costs the same after hours of chat
+        self.output_area = QPlainTextEdit()
+        self.output_area.setMaximumBlockCount(CHAT_LINES)
+        self.output_area.document().setUndoRedoEnabled(False)  # a read-only view needs no undo history
         self.input_field = QLineEdit()
 
+        #small live view of the other player's canvas
+        self.spectate_view = QLabel()
+        self.spectate_view.setFixedSize(200, 200)
+        self.spectate_view.setStyleSheet("border: 2px solid midnightblue;")
+
         #setting a placeholder!
-        self.input_field.setPlaceholderText("Write your text or /room <room_id> to join a room")
+        self.input_field.setPlaceholderText("Write your text, /room <room_id> to join a room or /play [players] to get matched")
 
         #chat cannot be edited
         self.output_area.setReadOnly(True)
@@ -236,9 +335,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.input_field.setStyleSheet("border: 2px solid midnightblue;")
         self.btn_send.setStyleSheet("border: 2px solid midnightblue; font-weight: bold; border-radius: 5px; background-color: wheat;")
 
-        self.chat_grid_layout.addWidget(self.output_area, 0, 0, 3, 4)
-        self.chat_grid_layout.addWidget(self.input_field, 3, 0, 1, 3)
-        self.chat_grid_layout.addWidget(self.btn_send, 3, 3, 1, 1)
+        self.chat_grid_layout.addWidget(self.spectate_view, 0, 0, 1, 4)
+        self.chat_grid_layout.addWidget(self.output_area, 1, 0, 3, 4)
+        self.chat_grid_layout.addWidget(self.input_field, 4, 0, 1, 3)
+        self.chat_grid_layout.addWidget(self.btn_send, 4, 3, 1, 1)
 
         #and setting color palette
         palette = QtWidgets.QHBoxLayout()
@@ -252,18 +352,129 @@ class MainWindow(QtWidgets.QMainWindow):
     #disconnection
     def closeEvent(self, event):
         self.sock_comm.disconnect()
+        self.images.wait()
         event.accept()
 
     def send_current_drawing(self):
-        #sends a current drawing to the server for exchange
+        #sends a current drawing to the server for exchange, the tiles are cut on a worker thread
+        snapshot = self.canvas.pixmap().copy()
+        base_id, base_hashes = self.tile_base or (None, None)
+        self.images.encode_tiles(self.canvas.to_image(), base_hashes,
+                                 lambda result: self.tiles_encoded(result, base_id, snapshot), key='upload')
+
+    def tiles_encoded(self, result, base_id, snapshot):
+        payload, hashes, changed = result
         try:
-            drawing_base64 = self.canvas.to_base64()
-            if drawing_base64:
-                self.sock_comm.send_message('drawing_ready', drawing_base64)
-                self.output_area.append("<span style='color: orange'>Your drawing has been sent for exchange!</span>")
+            self.sock_comm.send_message('drawing_tiles', {'base': base_id, 'tiles': payload})
+            self.pending_upload = (base_id, hashes, snapshot)
+            self.add_line("<span style='color: orange'>Your drawing has been sent for exchange!</span>")
         except Exception as e:
             print(f"Error sending drawing: {e}")
 
+    def tiles_acked(self, given):
+        #the server built the png of my upload (given = its id) or could not use my base (None)
+        if self.pending_upload is None:
+            return
+        base_id, hashes, snapshot = self.pending_upload
+        self.pending_upload = None
+        if given is not None:
+            self.set_tile_base(given, hashes)
+            self.uploads[given] = snapshot
+            if len(self.uploads) > 3:
+                del self.uploads[next(iter(self.uploads))]
+        else:
+            self.tile_base = None
+            if base_id is not None:
+                self.send_current_drawing()  # again, from a white canvas
+
+    def set_tile_base(self, base_id, hashes):
+        self.tile_base = (base_id, hashes)
+
+    def drawing_decoded(self, image, data):
+        # replace a current canva with a given one
+        self.canvas.set_image(image)
+        #the server keeps the received drawing as the base for my next upload
+        received_id = drawing_id(data['image_data'])
+        self.images.hash_tiles(image, lambda hashes: self.set_tile_base(received_id, hashes), key='base')
+        self.last_given = self.uploads.get(data.get('given'))
+        self.start_round(data.get('round', 0))
+        self.add_line(f"<span style='color: green'>You received a drawing from {data['username']}!</span>")
+        self.add_line("<span style='color: orange'>Continue drawing on the received canvas!</span>")
+
+    def send_strokes(self):
+        #sends what was drawn since the last batch
+        if self.canvas.stroke_log.is_empty():
+            return
+        batch = self.canvas.stroke_log.flush()
+        if self.sock_comm.current_room is not None:
+            self.sent_batches.append(batch)
+            self.sock_comm.send_message('strokes', {'round': self.round, 'strokes': batch})
+
+    def start_round(self, round_number):
+        #a new canvas to draw on: strokes drawn on the old one are not needed anymore
+        self.round = round_number
+        self.canvas.stroke_log.clear()
+        self.round_base = self.canvas.pixmap().copy()
+        self.sent_batches = []
+        self.spectate_pixmap = self.last_given.copy() if self.last_given else None
+        self.update_spectate_view()
+
+    def update_spectate_view(self):
+        if self.spectate_pixmap:
+            self.spectate_view.setPixmap(self.spectate_pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        else:
+            self.spectate_view.clear()
+
+    def apply_stroke_exchange(self, data):
+        #the other player's canvas = the one I gave them last time + their strokes
+        if self.last_given is None or self.round_base is None:
+            print("Got strokes without a base canvas")
+            return
+        received = self.last_given.copy()
+        draw_strokes(received, data['strokes'])
+
+        #and they got my round start + the batches the server took in time
+        given = self.round_base.copy()
+        draw_strokes(given, b''.join(self.sent_batches[:data['accepted']]))
+
+        self.last_given = given
+        self.canvas.setPixmap(received)
+        self.start_round(data['round'])
+
+    @pyqtSlot()
+    def schedule_inbox(self):
+        if not self.inbox_timer.isActive():
+            self.inbox_timer.start(FRAME_INTERVAL)
+
+    def add_line(self, html):
+        self.pending_lines.append(html)
+        self.schedule_inbox()
+
+    @pyqtSlot()
+    def process_inbox(self):
+        for message in self.sock_comm.take_messages():
+            self.event_recv(message)
+        self.flush_lines()
+
+    def flush_lines(self):
+        #all pending lines in one edit block, the document is laid out once for them
+        if not self.pending_lines:
+            return
+        lines, self.pending_lines = self.pending_lines, []
+        scroll = self.output_area.verticalScrollBar()
+        at_bottom = scroll.value() >= scroll.maximum()
+        document = self.output_area.document()
+        cursor = QtGui.QTextCursor(document)
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.beginEditBlock()
+        for line in lines:
+            if not document.isEmpty():
+                cursor.insertBlock()
+            cursor.insertHtml(line)
+        cursor.endEditBlock()
+        if at_bottom:
+            scroll.setValue(scroll.maximum())  # like append(), follow the chat unless scrolled up
+
     @pyqtSlot()  
     def event_send(self):
         text = self.input_field.text().strip() #remove extra chars form a msg (e.g. spaces in front of the text)
@@ -277,7 +488,18 @@ class MainWindow(QtWidgets.QMainWindow):
                     room_id = parts[1]
                     self.sock_comm.send_message('join_room', room_id)
                 else:
-                    self.output_area.append("<span style='color: red'>Usage: /room &lt;room_id&gt;</span>")
+                    self.add_line("<span style='color: red'>Usage: /room &lt;room_id&gt;</span>")
+            elif text.startswith('/play'):
+                #matchmaking, the server puts us in a room as soon as enough players are waiting
+                parts = text.split()
+                if len(parts) == 1:
+                    self.sock_comm.send_message('find_match', None)
+                elif len(parts) == 2 and parts[1].isdigit():
+                    self.sock_comm.send_message('find_match', int(parts[1]))
+                else:
+                    self.add_line("<span style='color: red'>Usage: /play [players]</span>")
+            elif text == '/stats':
+                self.add_line(f"<span style='color: gray'>Sent: {self.sock_comm.stats.summary()}</span>")
             else:
                 self.sock_comm.send_message('chat', text)
 
@@ -289,32 +511,49 @@ class MainWindow(QtWidgets.QMainWindow):
         data = message.get('data')
         
         if msg_type == 'system':
-            self.output_area.append(f"<span style='color: green'>{data}</span>")
+            self.add_line(f"<span style='color: green'>{data}</span>")
         elif msg_type == 'error':
-            self.output_area.append(f"<span style='color: red'>Error: {data}</span>")
+            self.add_line(f"<span style='color: red'>Error: {data}</span>")
         elif msg_type == 'chat':
             color = "midnightblue"
             text = f"<span style='color: {color}'><b>{data['username']}</b> [{data['timestamp']}]: {data['text']}</span>"
-            self.output_area.append(text)
+            self.add_line(text)
+        elif msg_type == 'chat_history':
+            #the last messages before we came, as the frames they were sent in
+            for frame in FrameBuffer().feed(data):
+                self.event_recv(decode(frame))
         elif msg_type == 'drawing_exchange':
+            #decoded on a worker thread, the canvas is swapped once the image is ready
+            self.images.decode(data['image_data'], lambda image: self.drawing_decoded(image, data),
+                               size=self.canvas.pixmap().size(), key='canvas')
+        elif msg_type == 'tiles_ack':
+            self.tiles_acked(data['given'])
+        elif msg_type == 'stroke_exchange':
             try:
-                # replace a current canva with a given one
-                self.canvas.from_base64(data['image_data'])
-                self.output_area.append(f"<span style='color: green'>You received a drawing from {data['username']}!</span>")
-                self.output_area.append("<span style='color: orange'>Continue drawing on the received canvas!</span>")
+                self.apply_stroke_exchange(data)
+                self.add_line(f"<span style='color: green'>You received a drawing from {data['username']}!</span>")
+                self.add_line("<span style='color: orange'>Continue drawing on the received canvas!</span>")
             except Exception as e:
-                print(f"Error loading drawing: {e}")
+                print(f"Error applying strokes: {e}")
+        elif msg_type == 'strokes':
+            # live strokes of the other player
+            if self.spectate_pixmap:
+                draw_strokes(self.spectate_pixmap, data['strokes'])
+                self.update_spectate_view()
         elif msg_type == 'room_joined':
-            self.output_area.append(f"<span style='color: blue'>You joined room: {data}</span>")
+            self.add_line(f"<span style='color: blue'>You joined room: {data}</span>")
             self.sock_comm.current_room = data
         elif msg_type == 'room_full':
-            self.output_area.append(f"<span style='color: blue'>Room {data} is now full! Game starting...</span>")
+            self.add_line(f"<span style='color: blue'>Room {data} is now full! Game starting...</span>")
+            # new game: the first exchange is a png, after that strokes are enough
+            self.last_given = None
+            self.start_round(0)
             # start the timer when room is full
             if not self.swap_timer_running:
                 self.swap_timer.start(45000)  # 45 sec
                 self.swap_timer_running = True
         elif msg_type == 'timer_start':
-            self.output_area.append(f"<span style='color: blue'>Timer started! You have 45 seconds to draw.</span>")
+            self.add_line(f"<span style='color: blue'>Timer started! You have 45 seconds to draw.</span>")
             # start the timer when server signals
             if not self.swap_timer_running:
                 self.swap_timer.start(45000)  # 45 sec
@@ -1,93 +1,221 @@
 import socket
-import pickle
-from threading import Thread, Timer
+from threading import Thread, Lock, RLock
 from datetime import datetime
+import itertools
 import random
 import time
+from archive import DrawingArchive
+from chat_history import ChatHistory
+from codec import decode
+import compression
+from drawing_store import DrawingStore
+import fanout
+import handshake
+from fanout import encode_frame, fan_out
+import log
+import metrics
+import profiling
+from matchmaking import Matchmaker
+from outbound import CHAT, DEFAULT_POLICY, DRAWING, OutboundQueue, message_kind
+from protocol import FrameBuffer
+from registry import Registry
+from scheduler import Scheduler
+from strokes import StrokeHistory, validate
+from tiles import TileError, apply_tiles
 
 BUFFER_SIZE = 65536
+OUTBOUND_POLICY = dict(DEFAULT_POLICY)  # slow consumer policy for every client queue
+DRAWING_MEMORY_BUDGET = 64 * 1024 * 1024
+DRAWING_SPILL_PATH = None  # e.g. 'drawings.seg' to keep evicted drawings on disk instead of dropping them
+ARCHIVE_DIR = 'archive'  # every exchanged drawing is appended here, None turns the archive off
+EXCHANGE_INTERVAL = 45.0
+SCHEDULER_SHARDS = 1  # threads firing the round timers of all rooms
+ROOM_SIZE = 2
+METRICS_PORT = metrics.METRICS_PORT  # /metrics over http on 127.0.0.1, None turns it off
+METRICS_DUMP_PATH = None  # e.g. 'metrics.prom' to write the metrics to a file every few seconds
+
+CONNECTIONS = metrics.counter('drawer_connections_total', "Connections accepted")
+MESSAGES = metrics.counter('drawer_messages_total', "Messages received, by type", label='type')
+BYTES_IN = metrics.counter('drawer_bytes_received_total', "Bytes read from the clients")
+BYTES_OUT = metrics.counter('drawer_bytes_sent_total', "Bytes written to the clients")
+DECODE_FAILURES = metrics.counter('drawer_decode_failures_total', "Messages that could not be decoded or handled")
+EXCHANGE_TIME = metrics.histogram('drawer_exchange_ms', "Time of one exchange round")
 
 class RoomHandler:
-    def __init__(self, room_id):
+    def __init__(self, room_id, server, size=ROOM_SIZE):
         self.room_id = room_id
-        self.clients = []
-        self.timer = None
+        self.server = server  # drawing store and archive
+        self.scheduler = server.scheduler
+        self.size = size  # 2 for /room, matchmaking rooms can be bigger
+        self.history = ChatHistory()  # last chat messages in the room, gone with the room
+        self.clients = ()  # snapshot of the members, replaced by the registry on every join / leave
+        self.timer = None  # ScheduledCall from the server's scheduler
         self.exchange_scheduled = False
+        self.lock = Lock()  # strokes come from the handler threads, the exchange from the timer
+        self.round = 0
+        #True when each player knows the canvas the other one started the round with,
+        #then the strokes of the round are enough and we don't need to send pngs
+        self.synced = False
+        self.canvas_from = {}  # player -> the player whose canvas they got in the last exchange
+
+    def set_clients(self, clients):
+        #called by the registry (under its lock) when somebody joins or leaves
+        self.clients = clients
+        self.new_game()
 
-    #adding clients to check if the room is full or not
-    def add_client(self, client):
-        if len(self.clients) < 2:
-            self.clients.append(client)
-            client.current_room = self.room_id
+    def new_game(self):
+        #somebody came or left, nobody knows the other canvas anymore
+        with self.lock:
+            self.round = 0
+            self.synced = False
+            self.canvas_from = {}
+            for client in self.clients:
+                client.strokes.reset()
+
+    def add_strokes(self, client, round_number, batch):
+        #keeps the strokes of the current round, returns False for strokes of an old round
+        with self.lock:
+            if not self.is_full() or round_number != self.round:
+                return False
+            client.strokes.add(batch)
             return True
-        return False
 
     def is_full(self):
-        return len(self.clients) == 2
-
-    def remove_client(self, client):
-        if client in self.clients:
-            self.clients.remove(client)
-            client.current_room = None
+        return len(self.clients) == self.size
 
     def start_timer(self):
         if self.is_full() and not self.exchange_scheduled:
             self.exchange_scheduled = True
             # start timer for 45 seconds
-            self.timer = Timer(45.0, self.exchange_drawings)
-            self.timer.start()
+            self.timer = self.scheduler.call_later(EXCHANGE_INTERVAL, self.exchange_drawings, key=self.room_id)
             
             #notify both clients
-            for client in self.clients:
-                timer_msg = {'type': 'timer_start', 'data': self.room_id}
-                try:
-                    #dumps() serializes the element and writes it to a file in binary format
-                    #convenient for direct saving of data to a file
-                    #so using it
-                    client.conn.send(pickle.dumps(timer_msg))
-                except:
-                    pass
+            timer_msg = {'type': 'timer_start', 'data': self.room_id}
+            fan_out(encode_frame(timer_msg), self.clients)
+
+    def cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
 
+    @profiling.span('exchange')
     def exchange_drawings(self):
-        if len(self.clients) == 2:
-            client1, client2 = self.clients
-            
-            # check if both clients have drawings
-            if client1.current_drawing and client2.current_drawing:
-                print(f"Exchanging drawings in room {self.room_id}")
-                
-                # send client2 drawing to client1
-                drawing_msg1 = {
-                    'type': 'drawing_exchange',
-                    'data': {
-                        'image_data': client2.current_drawing,
-                        'username': client2.name
-                    }
-                }
-                
-                # and visa versa :)
-                drawing_msg2 = {
-                    'type': 'drawing_exchange', 
-                    'data': {
-                        'image_data': client1.current_drawing,
-                        'username': client1.name
-                    }
-                }
-                
-                try:
-                    client1.conn.send(pickle.dumps(drawing_msg1))
-                    client2.conn.send(pickle.dumps(drawing_msg2))
-                    print(f"Successfully exchanged drawings in room {self.room_id}")
-                except Exception as e:
-                    print(f"Error sending drawings in room {self.room_id}: {e}")
-            
+        self.timer = None
+        started = time.perf_counter()
+        with self.lock:
+            clients = self.clients
+            #what this exchange hands out, a new upload meanwhile waits for the next one
+            held = {client: client.current_drawing for client in clients}
+            if len(clients) == 2:
+                archived = self.exchange_round(held, *clients)
+            elif len(clients) > 2:
+                archived = self.rotate_drawings(held, clients)
+            else:
+                archived = []
+
             #reset drawings and set timer for next exchange
-            for client in self.clients:
-                client.current_drawing = None
-            
-            #next exchange
-            self.exchange_scheduled = False
-            self.start_timer()
+            for client, drawing_id in held.items():
+                if drawing_id is not None:
+                    client.clear_drawing(drawing_id)
+        #the disk writes don't hold up the room (and the registry waiting on it)
+        for author, receiver, drawing_id in archived:
+            self.server.archive_drawing(self.room_id, author, receiver, drawing_id)
+        EXCHANGE_TIME.observe_since(started)
+
+        #next exchange
+        self.exchange_scheduled = False
+        self.start_timer()
+
+    def exchange_round(self, held, client1, client2):
+        #returns what goes to the archive: (author, receiver, drawing id)
+        if self.synced and not client1.strokes.overflowed and not client2.strokes.overflowed:
+            #both know where the other one started, so only this round's strokes go out
+            self.round += 1
+            log.debug('strokes_exchanged', room=self.room_id, round=self.round)
+            client1.send(self.stroke_exchange_msg(client1, client2))
+            client2.send(self.stroke_exchange_msg(client2, client1))
+
+        # check if both clients have drawings
+        elif self.has_drawing(held[client1]) and self.has_drawing(held[client2]):
+            self.round += 1
+
+            # send client2 drawing to client1 and visa versa :)
+            client1.send(self.drawing_exchange_msg(held, client1, client2))
+            client2.send(self.drawing_exchange_msg(held, client2, client1))
+            log.debug('drawings_exchanged', room=self.room_id, round=self.round)
+            self.synced = True
+            #the received drawing is the canvas they go on with, their next tiles build on it
+            client1.set_tile_base(held[client2])
+            client2.set_tile_base(held[client1])
+
+        else:
+            return []  # nothing was exchanged, the round goes on
+
+        self.canvas_from = {client1: client2, client2: client1}
+        for client in (client1, client2):
+            client.strokes.reset()
+        return self.to_archive(held, [(client1, client2), (client2, client1)])
+
+    def rotate_drawings(self, held, clients):
+        #rooms of more than 2: every drawing goes one player further (always pngs, the
+        #strokes only work when both players swap)
+        ready = [client for client in clients if self.has_drawing(held[client])]
+        if len(ready) < 2:
+            return []
+        self.round += 1
+        log.debug('drawings_rotated', room=self.room_id, round=self.round, players=len(ready))
+        self.canvas_from = {}
+        for i, receiver in enumerate(ready):
+            sender = ready[i - 1]
+            self.canvas_from[receiver] = sender
+            receiver.send(self.drawing_exchange_msg(held, receiver, sender))
+            receiver.set_tile_base(held[sender])
+        for client in clients:
+            client.strokes.reset()
+        return self.to_archive(held, [(ready[i - 1], receiver) for i, receiver in enumerate(ready)])
+
+    def has_drawing(self, drawing_id):
+        #the store may have dropped it when it ran out of memory
+        return drawing_id is not None and self.server.drawings.has(drawing_id)
+
+    def to_archive(self, held, exchanged):
+        #the archive gets its own reference, the exchange releases the held ones right after
+        if self.server.archive is None:
+            return []
+        return [(author.name, receiver.name, held[author]) for author, receiver in exchanged
+                if self.server.drawings.retain(held[author])]
+
+    def watcher(self, client):
+        #the player whose canvas this client draws on (it sent it in the last exchange),
+        #they watch the live strokes on top of the canvas they gave away
+        with self.lock:
+            source = self.canvas_from.get(client)
+            return source if source in self.clients else None
+
+    def drawing_exchange_msg(self, held, receiver, sender):
+        #given = id of the receiver's own png that went to the sender (drawing_store.drawing_id)
+        return {
+            'type': 'drawing_exchange',
+            'data': {
+                'image_data': self.server.drawings.get(held[sender]),
+                'username': sender.name,
+                'round': self.round,
+                'given': held[receiver]
+            }
+        }
+
+    def stroke_exchange_msg(self, receiver, sender):
+        #accepted = how many of the receiver's own batches made it into this round,
+        #the receiver needs it to know exactly which canvas the sender got
+        return {
+            'type': 'stroke_exchange',
+            'data': {
+                'strokes': sender.strokes.joined(),
+                'username': sender.name,
+                'accepted': receiver.strokes.accepted(),
+                'round': self.round
+            }
+        }
 
 class Server(Thread):
     def __init__(self, address: str, port: int):
@@ -95,35 +223,109 @@ class Server(Thread):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind((address, port))
         self.sock.listen()
-        self.clients = []
-        self.rooms = {}  # room_id to RoomHandler object
+        self.registry = Registry()  # connected clients and room members
+        self.drawings = DrawingStore(DRAWING_MEMORY_BUDGET, DRAWING_SPILL_PATH)  # stores the users drawings
+        self.archive = DrawingArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
+        self.scheduler = Scheduler(SCHEDULER_SHARDS)  # round timers of all rooms
+        self.matchmaker = Matchmaker()  # players waiting for /play
+        self.chat_history = ChatHistory()  # last messages of the global chat
+        self.match_ids = itertools.count(1)
+        self.add_metrics()
         self.start()
 
     def run(self):
-        print("Server started at 127.0.0.1:9003")
+        log.info('server_started', address="127.0.0.1:9003")
         
         while True:
             try:
                 client_conn, client_addr = self.sock.accept()
-                print(f"Client with address {client_addr} connected!")
-                client_handler = ClientHandler(client_conn, self)
-                self.clients.append(client_handler)
+                CONNECTIONS.inc()
+                log.info('client_connected', address=client_addr)
+                ClientHandler(client_conn, self)
                 
             except Exception as e:
-                print(f"Server error: {e}")
+                log.error('accept_failed', error=e)
+
+    def add_metrics(self):
+        #gauges are read from the live state when somebody asks for the metrics
+        metrics.gauge('drawer_clients', "Connected clients", lambda: len(self.registry))
+        metrics.gauge('drawer_rooms', "Open rooms", lambda: len(self.registry.rooms))
+        metrics.gauge('drawer_outbound_frames', "Frames waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[0] for client in self.registry.all_clients()))
+        metrics.gauge('drawer_outbound_bytes', "Bytes waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[1] for client in self.registry.all_clients()))
+        metrics.gauge('drawer_drawings_stored', "Drawings in the drawing store", lambda: self.drawings.stats()['drawings'])
+        metrics.gauge('drawer_timers_pending', "Round timers waiting to fire", lambda: self.scheduler.stats()['pending'])
+        metrics.gauge('drawer_matchmaking_waiting', "Players waiting for a match",
+                      lambda: sum(self.matchmaker.stats()['waiting'].values()))
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        if METRICS_DUMP_PATH:
+            metrics.dump_every(METRICS_DUMP_PATH)
+
+    def archive_drawing(self, room_id, author, receiver, drawing_id):
+        #keeps a copy of the exchanged drawing on disk for the gallery / replay, takes over the
+        #reference the room got for it (RoomHandler.to_archive)
+        drawing = self.drawings.get(drawing_id)
+        self.drawings.release(drawing_id)
+        if drawing is not None:
+            self.archive.append(room_id, author, receiver, drawing)
+
+    def queue_depths(self):
+        #how much is waiting for every client: {name: (frames, bytes)}
+        return {client.name: client.outbound.depth() for client in self.registry.all_clients()}
+
+    def scheduler_stats(self):
+        #pending timers and how late the exchanges fire under load
+        return self.scheduler.stats()
+
+    def matchmaking_stats(self):
+        #players waiting per room size and how long it took them to get a game
+        return self.matchmaker.stats()
+
+    def new_room(self, room_id, size=ROOM_SIZE):
+        return RoomHandler(room_id, self, size)
+
+    def join_room(self, client, room_id, size=ROOM_SIZE):
+        #returns the room or None if it is full, size is only used when the room is new
+        factory = lambda room_id: self.new_room(room_id, size)
+        with self.registry.lock:
+            room = self.registry.get_or_create_room(room_id, factory)
+            return self.registry.join_room(client.client_id, room_id, factory, room.size)
+
+    def find_match(self, client, size):
+        try:
+            players = self.matchmaker.enqueue(client.client_id, client, size)
+        except ValueError as e:
+            client.send({'type': 'error', 'data': f"Can't look for a game: {e}"})
+            return
+        if players is None:
+            client.send({'type': 'system', 'data': f"Looking for a game of {size} players..."})
+            return
 
-    def get_or_create_room(self, room_id):
-        if room_id not in self.rooms:
-            self.rooms[room_id] = RoomHandler(room_id)
-        return self.rooms[room_id]
+        self.start_match(players, size)
+
+    def start_match(self, players, size):
+        #enough players, they all get a fresh room
+        while players:
+            room_id = f"match-{next(self.match_ids)}"
+            log.info('match_made', room=room_id, players=','.join(player.name for player in players))
+            joined = [player for player in players if player.enter_room(room_id, size)]
+            if len(joined) == size:
+                self.matchmaker.started(joined)
+                return
+            #somebody disconnected in the meantime, the room would never be full:
+            #it is closed and the others wait again, first in line
+            log.info('match_failed', room=room_id, joined=len(joined))
+            for player in joined:
+                player.leave_room()
+                player.send({'type': 'system', 'data': "A player left before the game started, looking for another one..."})
+            players = self.matchmaker.requeue(joined, size)
 
     def remove_empty_rooms(self):
-        empty_rooms = [room_id for room_id, room in self.rooms.items() if len(room.clients) == 0]
-        for room_id in empty_rooms:
-            if room_id in self.rooms:
-                if self.rooms[room_id].timer:
-                    self.rooms[room_id].timer.cancel()
-                del self.rooms[room_id]
+        #only the rooms that became empty since the last call, no scan over all rooms
+        for room in self.registry.pop_empty_rooms():
+            room.cancel_timer()
 
 class ClientHandler(Thread):
     def __init__(self, conn, server):
@@ -132,151 +334,281 @@ class ClientHandler(Thread):
         self.server = server
         self.name = "Unknown"
         self.current_drawing = None
+        self.tile_base = None  # drawing id the client's tiles are relative to (see set_tiles)
+        #the handler thread and the exchange both swap current_drawing / tile_base, every id
+        #that is swapped out is released exactly once by whoever swapped it
+        self.drawing_lock = RLock()
         self.current_room = None
+        self.strokes = StrokeHistory()  # what this player drew during the current round
+        self.frames = FrameBuffer()
+        self.protocol_version = handshake.LEGACY_VERSION
+        self.compressor = None  # compression.FrameCompressor when the client agreed on compression
+        #outgoing frames wait here, only the writer thread touches the socket for sending
+        self.outbound = OutboundQueue(**OUTBOUND_POLICY)
+        #registered before the thread starts, so the cleanup in run always finds it
+        self.client_id = server.registry.add_client(self)
+        #started after the handshake, the answer to the hello has to be the first thing sent
+        self.writer = Thread(target=self.write_loop, daemon=True)
         self.start()
 
     def run(self):
         try:
-            # getting a username
-            name_data = self.conn.recv(1024)
-            self.name = name_data.decode('utf-8').strip()
-            print(f"Client registered as: {self.name}")
+            # getting a username (and what the client supports, see handshake.py)
+            self.name, self.protocol_version, method, early_frames = handshake.accept(self.conn, self.frames)
+            self.compressor = compression.frame_compressor(method)
+            self.writer.start()
+            log.info('client_registered', name=self.name, version=self.protocol_version, compression=method)
             
             # greetings
-            welcome_msg = {'type': 'system', 'data': f"Hello, {self.name}! Use /room <room_id> to join a room."}
-            self.conn.send(pickle.dumps(welcome_msg))
+            welcome_msg = {'type': 'system', 'data': f"Hello, {self.name}! Use /room <room_id> to join a room or /play [players] to get matched."}
+            self.send(welcome_msg)
+            self.send_history(self.server.chat_history)
             
             # "meet-a-new-user" message
             join_msg = {'type': 'system', 'data': f"{self.name} joined the chat!"}
             self.broadcast(join_msg, include_self=True)
             
+            for frame in early_frames:
+                self.handle_frame(frame)
+
             # main loop
             while True:
                 data = self.conn.recv(BUFFER_SIZE)
                 if not data:
                     break
-                    
-                try:
-                    #converts a byte string representing a serialized object back to the original object in memory
-                    message = pickle.loads(data)
-                    self.process_message(message)
-                except Exception as e:
-                    print(f"Error decoding message: {e}")
+                BYTES_IN.inc(len(data))
+
+                #one recv can hold several messages or just a piece of one
+                for frame in self.frames.feed(data):
+                    self.handle_frame(frame)
                     
         except Exception as e:
-            print(f"Client {self.name} error: {e}")
+            log.warning('client_error', name=self.name, error=e)
         finally:
+            self.outbound.close()
+            if self.writer.ident is None:
+                self.conn.close()  # the handshake failed, no writer to close it
+            self.server.matchmaker.remove(self.client_id)
+            self.clear_drawing()
+            self.set_tile_base(None)
             self.leave_room()
-            if self in self.server.clients:
-                self.server.clients.remove(self)
+            self.server.registry.remove_client(self.client_id)
             # informing others about person who leaves the chat
             leave_msg = {'type': 'system', 'data': f"{self.name} left the chat!"}
             self.broadcast(leave_msg, include_self=False)
-            self.server.remove_empty_rooms()
-            print(f"Client {self.name} disconnected")
+            log.info('client_disconnected', name=self.name)
+
+    def handle_frame(self, frame):
+        try:
+            message = decode(frame)
+            MESSAGES.inc(label=metrics.message_type(message))
+            self.process_message(message)
+        except Exception as e:
+            DECODE_FAILURES.inc()
+            log.warning('bad_message', name=self.name, error=e)
+
+    def write_loop(self):
+        #drains the outbound queue, a slow socket only blocks this thread
+        while True:
+            batch = self.outbound.get_batch()
+            if batch is None:
+                break
+            try:
+                data = b''.join(batch)
+                self.conn.sendall(data)
+                BYTES_OUT.inc(len(data))
+            except Exception as e:
+                self.outbound.close(f"send failed: {e}")
+                break
+
+        if self.outbound.close_reason:
+            log.warning('client_dropped', name=self.name, reason=self.outbound.close_reason)
+        #wakes up the reader thread so that the usual cleanup runs
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_frame(self, frame, kind='other'):
+        #never blocks, frames are already encoded so broadcasts can share one buffer
+        if self.compressor is not None:
+            frame = self.compressor.frame(frame, skip=kind == DRAWING)
+        return self.outbound.put(frame, kind)
+
+    def send(self, message):
+        #sends one framed message to this client
+        return self.send_frame(encode_frame(message), message_kind(message.get('type')))
+
+    def send_history(self, history):
+        #the last messages in one frame, for clients that know chat_history
+        frame = history.frame()
+        if frame is not None and self.protocol_version >= handshake.HISTORY_VERSION:
+            self.send_frame(frame, CHAT)
+
+    def set_drawing(self, data):
+        #the store keeps the bytes (once per content), the handler only keeps the id
+        key = self.server.drawings.put(data)
+        with self.drawing_lock:
+            old_drawing, self.current_drawing = self.current_drawing, key
+        self.server.drawings.release(old_drawing)
+        return key
+
+    def clear_drawing(self, exchanged=None):
+        #exchanged = the id an exchange handed out, a newer upload stays for the next exchange
+        with self.drawing_lock:
+            old_drawing = self.current_drawing
+            if exchanged is not None and old_drawing != exchanged:
+                return
+            self.current_drawing = None
+        self.server.drawings.release(old_drawing)
+
+    def set_tile_base(self, key):
+        #the drawing the client's next tiles are relative to, kept in the store until it moves on
+        new_base = key if key is not None and self.server.drawings.retain(key) else None
+        with self.drawing_lock:
+            old_base, self.tile_base = self.tile_base, new_base
+        self.server.drawings.release(old_base)
+
+    def set_tiles(self, base, payload):
+        #changed tiles on top of a drawing we both know (tiles.py), the result is a normal png
+        try:
+            base_png = None
+            if base is not None:
+                if base != self.tile_base:
+                    raise TileError("Unknown tile base")
+                base_png = self.server.drawings.get(base)
+                if base_png is None:
+                    raise TileError("Tile base is gone")
+            drawing = apply_tiles(base_png, payload)
+        except TileError as e:
+            #the client starts over from a white canvas
+            log.warning('tiles_rejected', name=self.name, error=e)
+            self.send({'type': 'tiles_ack', 'data': {'given': None}})
+            return
+        with self.drawing_lock:
+            #an exchange can't clear the drawing before it became the tile base
+            key = self.set_drawing(drawing)
+            self.set_tile_base(key)
+        self.send({'type': 'tiles_ack', 'data': {'given': key}})
+
+    def has_drawing(self):
+        #the store may have dropped it when it ran out of memory
+        return self.current_drawing is not None and self.server.drawings.has(self.current_drawing)
 
     def broadcast(self, message, include_self=False):
-        #sends messages to everyone
-        for client in self.server.clients:
-            if client != self or include_self:
-                try:
-                    client.conn.send(pickle.dumps(message))
-                except:
-                    pass
+        #sends messages to everyone, the message is encoded only once
+        recipients = [client for client in self.server.registry.all_clients() if client != self or include_self]
+        fanout.broadcast(message, recipients)
 
     def broadcast_to_room(self, message, include_self=False):
         #sends messages to everyone in the same room
-        if self.current_room and self.current_room in self.server.rooms:
-            room = self.server.rooms[self.current_room]
-            for client in room.clients:
-                if client != self or include_self:
-                    try:
-                        client.conn.send(pickle.dumps(message))
-                    except:
-                        pass
+        room = self.server.registry.room(self.current_room)
+        if room:
+            recipients = [client for client in room.clients if client != self or include_self]
+            fanout.broadcast(message, recipients)
 
     def leave_room(self):
-        if self.current_room and self.current_room in self.server.rooms:
-            room = self.server.rooms[self.current_room]
-            room.remove_client(self)
-            
+        room = self.server.registry.leave_room(self.client_id)
+        if room:
             # notify room members
-            leave_msg = {'type': 'system', 'data': f"{self.name} left room {self.current_room}"}
-            self.broadcast_to_room(leave_msg, include_self=False)
+            leave_msg = {'type': 'system', 'data': f"{self.name} left room {room.room_id}"}
+            fanout.broadcast(leave_msg, room.clients)
             
-            print(f"Client {self.name} left room {self.current_room}")
+            log.info('room_left', name=self.name, room=room.room_id)
+            self.server.remove_empty_rooms()
+        self.current_room = None
 
+    @profiling.message_span
     def process_message(self, message):
         msg_type = message.get('type')
         data = message.get('data')
         
         if msg_type == 'chat':
-            if self.current_room:
-                # send to room only
-                chat_msg = {
-                    'type': 'chat', 
-                    'data': {
-                        'text': data,
-                        'username': self.name,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    }
+            chat_msg = {
+                'type': 'chat', 
+                'data': {
+                    'text': data,
+                    'username': self.name,
+                    'timestamp': datetime.now().strftime('%H:%M:%S')
                 }
-                self.broadcast_to_room(chat_msg, include_self=True)
-            else:
+            }
+            #encoded once, the same frame goes to the history for the ones who come later
+            frame = encode_frame(chat_msg)
+            room = self.server.registry.room(self.current_room)
+            if room:
+                # send to room only
+                room.history.add(frame)
+                fan_out(frame, room.clients, CHAT)
+            elif not self.current_room:
                 # send to everyone (global chat)
-                chat_msg = {
-                    'type': 'chat', 
-                    'data': {
-                        'text': data,
-                        'username': self.name,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    }
-                }
-                self.broadcast(chat_msg, include_self=True)
+                self.server.chat_history.add(frame)
+                fan_out(frame, self.server.registry.all_clients(), CHAT)
                         
         elif msg_type == 'drawing_ready':
             # saving a drawing for exchange
-            self.current_drawing = data
-            print(f"Received drawing from {self.name} in room {self.current_room}")
+            self.set_drawing(data)
+            log.debug('drawing_received', name=self.name, room=self.current_room)
+
+        elif msg_type == 'drawing_tiles':
+            # only the tiles that changed, the server builds the png
+            self.set_tiles(data['base'], data['tiles'])
+            log.debug('tiles_received', name=self.name, room=self.current_room)
+
+        elif msg_type == 'strokes':
+            room = self.server.registry.room(self.current_room)
+            batch = data['strokes']
+            validate(batch)
+            if room and room.add_strokes(self, data['round'], batch):
+                #live strokes for the other player, so they can watch
+                stroke_msg = {'type': 'strokes', 'data': {'username': self.name, 'strokes': batch}}
+                watcher = room.watcher(self)
+                if watcher is not None:
+                    watcher.send(stroke_msg)
             
         elif msg_type == 'join_room':
             room_id = data
+            self.server.matchmaker.remove(self.client_id)
             self.leave_room()  # leave current room if it exists
+            self.enter_room(room_id)
+
+        elif msg_type == 'find_match':
+            #data = wanted room size, or None for a normal 2 player game
+            size = ROOM_SIZE if data is None else int(data)
+            self.leave_room()
+            self.server.find_match(self, size)
+
+    def enter_room(self, room_id, size=ROOM_SIZE):
+        #returns True if the player is in the room now
+        room = self.server.join_room(self, room_id, size)
+        
+        if room:
+            # successfully joined the room!!
+            self.current_room = room_id
+            room_msg = {'type': 'room_joined', 'data': room_id}
+            self.send(room_msg)  # only queued, a closed connection just drops it
+            self.send_history(room.history)
             
-            room = self.server.get_or_create_room(room_id)
+            #notify room members
+            join_msg = {'type': 'system', 'data': f"{self.name} joined room {room_id}"}
+            self.broadcast_to_room(join_msg, include_self=True)
             
-            if room.add_client(self):
-                # successfully joined the room!!
-                room_msg = {'type': 'room_joined', 'data': room_id}
-                try:
-                    self.conn.send(pickle.dumps(room_msg))
-                except:
-                    pass
-                
-                #notify room members
-                join_msg = {'type': 'system', 'data': f"{self.name} joined room {room_id}"}
-                self.broadcast_to_room(join_msg, include_self=True)
-                
-                print(f"Client {self.name} joined room {room_id}")
-                
-                # check if room is full and start timer
-                if room.is_full():
-                    full_msg = {'type': 'room_full', 'data': room_id}
-                    for client in room.clients:
-                        try:
-                            client.conn.send(pickle.dumps(full_msg))
-                        except:
-                            pass
-                    room.start_timer()
-            else:
-                # when somebody tryna access the room that is full
-                error_msg = {'type': 'error', 'data': f"Room {room_id} is full (max 2 players)"}
-                try:
-                    self.conn.send(pickle.dumps(error_msg))
-                except:
-                    pass
+            log.info('room_joined', name=self.name, room=room_id)
+            
+            # check if room is full and start timer
+            if room.is_full():
+                full_msg = {'type': 'room_full', 'data': room_id}
+                fan_out(encode_frame(full_msg), room.clients)
+                room.start_timer()
+            return True
+        else:
+            # when somebody tryna access the room that is full
+            room = self.server.registry.room(room_id)
+            error_msg = {'type': 'error', 'data': f"Room {room_id} is full (max {room.size if room else size} players)"}
+            self.send(error_msg)  # only queued, a closed connection just drops it
+            return False
 
 if __name__ == '__main__':
+    profiling.install()
     server = Server("127.0.0.1", 9003)
     
     try:
@@ -284,4 +616,4 @@ if __name__ == '__main__':
             input("Press enter to stop the server\n")
             break
     except KeyboardInterrupt:
-        print("Server stopped!")
\ No newline at end of file
+        log.info('server_stopped')
\ No newline at end of file
@@ -0,0 +1,137 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from threading import Lock
+
+#append-only archive of every drawing that went through an exchange
+#  drawings.dat - [room_id \0 author \0 receiver][png bytes], one after another
+#  drawings.idx - one fixed-size record per drawing: timestamp, offset, meta length, png length
+#both files are only ever appended to, reading goes through mmap so the pngs stay off the heap
+
+INDEX_RECORD = struct.Struct('!dQHI')  # timestamp, offset in drawings.dat, meta length, png length
+
+ArchiveEntry = namedtuple('ArchiveEntry', 'timestamp room_id author receiver image')
+
+
+class MappedFile:
+    #read-only mmap of a file that keeps growing, mapped again when we need the new end
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = None
+        self.size = 0
+
+    def view(self, offset, length):
+        end = offset + length
+        if end > self.size:
+            self._remap()
+            if end > self.size:
+                raise IndexError("Archive record out of range")
+        return memoryview(self.map)[offset:end]
+
+    def _remap(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            return
+        #old views may still be alive somewhere, so the old map is left to the garbage collector
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        self.size = size
+
+    def close(self):
+        self.map = None
+        self.file.close()
+
+
+class DrawingArchive:
+    def __init__(self, directory='archive'):
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, 'drawings.dat')
+        self.index_path = os.path.join(directory, 'drawings.idx')
+        self.lock = Lock()
+        self.count = self._recover()
+        self.data_file = open(self.data_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+        self.data = MappedFile(self.data_path)
+        self.index = MappedFile(self.index_path)
+
+    def _recover(self):
+        #a crash can leave half a record at the end of either file. both are cut back to the
+        #last complete record, otherwise the next appends would land after the torn bytes
+        for path in (self.data_path, self.index_path):
+            open(path, 'ab').close()
+        data_size = os.path.getsize(self.data_path)
+        with open(self.index_path, 'r+b') as index:
+            count = os.path.getsize(self.index_path) // INDEX_RECORD.size
+            data_end = 0
+            while count:
+                index.seek((count - 1) * INDEX_RECORD.size)
+                _, offset, meta_length, image_length = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+                data_end = offset + meta_length + image_length
+                if data_end <= data_size:
+                    break
+                count -= 1  # the record made it to disk, its data did not
+                data_end = 0
+            index.truncate(count * INDEX_RECORD.size)
+        if data_size > data_end:
+            os.truncate(self.data_path, data_end)
+        return count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, room_id, author, receiver, image, timestamp=None):
+        #stores one drawing, returns its number in the archive
+        #the fields are NUL separated and chosen by the clients, so they can't contain NUL themselves
+        fields = (str(room_id or ''), author, receiver)
+        meta = '\0'.join(field.replace('\0', '') for field in fields).encode('utf-8')
+        with self.lock:
+            offset = self.data_file.tell()
+            self.data_file.write(meta)
+            self.data_file.write(image)
+            self.data_file.flush()
+            #the index record goes last, so a reader never sees a record without its data
+            self.index_file.write(INDEX_RECORD.pack(timestamp or time.time(), offset, len(meta), len(image)))
+            self.index_file.flush()
+            self.count += 1
+            return self.count - 1
+
+    def entry(self, number):
+        #the image is a memoryview into the mmap, no copy of the png is made
+        if not 0 <= number < self.count:
+            raise IndexError(number)
+        timestamp, offset, meta_length, image_length = INDEX_RECORD.unpack(
+            self.index.view(number * INDEX_RECORD.size, INDEX_RECORD.size))
+        meta = bytes(self.data.view(offset, meta_length)).decode('utf-8')
+        room_id, author, receiver = meta.split('\0', 2)  # records of older versions may have more NULs
+        image = self.data.view(offset + meta_length, image_length)
+        return ArchiveEntry(timestamp, room_id, author, receiver, image)
+
+    def entries(self, room_id=None, start=0):
+        #replay in the order the drawings were exchanged, optionally for one room only
+        for number in range(start, self.count):
+            entry = self.entry(number)
+            if room_id is None or entry.room_id == str(room_id):
+                yield entry
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+        self.data.close()
+        self.index.close()
+
+
+if __name__ == '__main__':
+    #tiny gallery: python archive.py [directory] [number out.png]
+    archive = DrawingArchive(sys.argv[1] if len(sys.argv) > 1 else 'archive')
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'wb') as out:
+            out.write(archive.entry(int(sys.argv[2])).image)
+    else:
+        for number, entry in enumerate(archive.entries()):
+            when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.timestamp))
+            print(f"{number:>6}  {when}  room {entry.room_id or '-':<8} {entry.author} -> {entry.receiver}"
+                  f"  {len(entry.image)} bytes")
+    archive.close()
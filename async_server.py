@@ -0,0 +1,705 @@
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import time
+from datetime import datetime
+from multiprocessing import Process
+from archive import DrawingArchive
+from chat_history import ChatHistory
+import broker
+from broker import BrokerLink
+from codec import decode
+import compression
+from drawing_store import DrawingStore
+import fanout
+import handshake
+from fanout import encode_frame, fan_out
+import log
+import metrics
+import profiling
+from outbound import CHAT, DEFAULT_POLICY, DRAWING, AsyncOutboundQueue, message_kind
+from protocol import HEADER, read_frame
+from strokes import StrokeHistory, validate
+from tiles import TileError, apply_tiles
+
+#asyncio engine for the room game (same messages as SemProj-server.py)
+#one event loop for everybody instead of a thread per client and a Timer thread per room.
+#for 10k connections raise the open files limit first (ulimit -n 20000)
+#
+#python async_server.py --workers 4 runs 4 processes that accept on the same port (SO_REUSEPORT)
+#plus a broker process that keeps the rooms together across them (see broker.py)
+
+EXCHANGE_INTERVAL = 45.0
+ACCEPT_BACKLOG = 4096
+OUTBOUND_POLICY = dict(DEFAULT_POLICY)  # slow consumer policy for every client queue
+DRAWING_MEMORY_BUDGET = 64 * 1024 * 1024
+DRAWING_SPILL_PATH = None  # e.g. 'drawings.seg' to keep evicted drawings on disk instead of dropping them
+ARCHIVE_DIR = 'archive'  # every exchanged drawing is appended here, None turns the archive off
+METRICS_PORT = metrics.METRICS_PORT  # /metrics over http on 127.0.0.1 (+ worker number), None turns it off
+METRICS_DUMP_PATH = None  # e.g. 'metrics.prom' to write the metrics to a file every few seconds
+
+CONNECTIONS = metrics.counter('drawer_connections_total', "Connections accepted")
+MESSAGES = metrics.counter('drawer_messages_total', "Messages received, by type", label='type')
+BYTES_IN = metrics.counter('drawer_bytes_received_total', "Bytes read from the clients")
+BYTES_OUT = metrics.counter('drawer_bytes_sent_total', "Bytes written to the clients")
+DECODE_FAILURES = metrics.counter('drawer_decode_failures_total', "Messages that could not be decoded or handled")
+EXCHANGE_TIME = metrics.histogram('drawer_exchange_ms', "Time of one exchange round")
+
+
+class RoomHandler:
+    __slots__ = ('room_id', 'loop', 'clients', 'timer', 'exchange_scheduled', 'round', 'synced', 'history')
+
+    def __init__(self, room_id, loop):
+        self.room_id = room_id
+        self.loop = loop
+        self.clients = []
+        self.timer = None  # asyncio.TimerHandle from loop.call_later
+        self.exchange_scheduled = False
+        self.round = 0
+        #True when each player knows the canvas the other one started the round with,
+        #then the strokes of the round are enough and we don't need to send pngs
+        self.synced = False
+        self.history = ChatHistory()  # last chat messages in the room, gone with the room
+
+    #adding clients to check if the room is full or not
+    def add_client(self, client):
+        if len(self.clients) < 2:
+            self.clients.append(client)
+            client.current_room = self.room_id
+            self.new_game()
+            return True
+        return False
+
+    def new_game(self):
+        #somebody came or left, nobody knows the other canvas anymore
+        self.round = 0
+        self.synced = False
+        for client in self.clients:
+            client.strokes.reset()
+
+    def add_strokes(self, client, round_number, batch):
+        #keeps the strokes of the current round, returns False for strokes of an old round
+        if not self.is_full() or round_number != self.round:
+            return False
+        client.strokes.add(batch)
+        return True
+
+    def is_full(self):
+        return len(self.clients) == 2
+
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            client.current_room = None
+            self.new_game()
+
+    def start_timer(self):
+        if self.is_full() and not self.exchange_scheduled:
+            self.exchange_scheduled = True
+            #the loop calls us back in 45 seconds, no thread needed
+            self.timer = self.loop.call_later(EXCHANGE_INTERVAL, self.exchange_drawings)
+
+            #notify both clients
+            timer_msg = {'type': 'timer_start', 'data': self.room_id}
+            fan_out(encode_frame(timer_msg), self.clients)
+
+    def cancel_timer(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    @profiling.span('exchange')
+    def exchange_drawings(self):
+        self.timer = None
+        started = time.perf_counter()
+        if len(self.clients) == 2:
+            self.exchange_round(*self.clients)
+
+        #reset drawings and set timer for next exchange
+        for client in self.clients:
+            client.clear_drawing()
+        EXCHANGE_TIME.observe_since(started)
+
+        #next exchange
+        self.exchange_scheduled = False
+        self.start_timer()
+
+    def exchange_round(self, client1, client2):
+        if self.synced and not client1.strokes.overflowed and not client2.strokes.overflowed:
+            #both know where the other one started, so only this round's strokes go out
+            self.round += 1
+            log.debug('strokes_exchanged', room=self.room_id, round=self.round)
+            client1.send(self.stroke_exchange_msg(client1, client2))
+            client2.send(self.stroke_exchange_msg(client2, client1))
+
+        # check if both clients have drawings
+        elif client1.has_drawing() and client2.has_drawing():
+            self.round += 1
+            log.debug('drawings_exchanged', room=self.room_id, round=self.round)
+
+            # send client2 drawing to client1 and visa versa
+            client1.send(self.drawing_exchange_msg(client1, client2))
+            client2.send(self.drawing_exchange_msg(client2, client1))
+            self.synced = True
+            #the received drawing is the canvas they go on with, their next tiles build on it
+            client1.set_tile_base(client2.current_drawing)
+            client2.set_tile_base(client1.current_drawing)
+
+        else:
+            return  # nothing was exchanged, the round goes on
+
+        client1.server.archive_drawing(self.room_id, client1, client2)
+        client2.server.archive_drawing(self.room_id, client2, client1)
+        for client in (client1, client2):
+            client.strokes.reset()
+
+    def drawing_exchange_msg(self, receiver, sender):
+        #given = id of the receiver's own png that went to the sender (drawing_store.drawing_id)
+        return {
+            'type': 'drawing_exchange',
+            'data': {
+                'image_data': sender.server.drawings.get(sender.current_drawing),
+                'username': sender.name,
+                'round': self.round,
+                'given': receiver.current_drawing
+            }
+        }
+
+    def stroke_exchange_msg(self, receiver, sender):
+        #accepted = how many of the receiver's own batches made it into this round,
+        #the receiver needs it to know exactly which canvas the sender got
+        return {
+            'type': 'stroke_exchange',
+            'data': {
+                'strokes': sender.strokes.joined(),
+                'username': sender.name,
+                'accepted': receiver.strokes.accepted(),
+                'round': self.round
+            }
+        }
+
+
+class ClientHandler:
+    #slots keep the per-connection footprint small and flat
+    __slots__ = ('reader', 'writer', 'server', 'client_id', 'name', 'current_drawing', 'tile_base',
+                 'current_room', 'remote_home', 'strokes', 'outbound', 'protocol_version', 'compressor',
+                 'tiles_task')
+
+    def __init__(self, reader, writer, server, client_id=None):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_id = client_id or server.new_client_id()
+        self.name = "Unknown"
+        self.remote_home = None  # worker the room lives on, when it is not this one
+        self.current_drawing = None
+        self.tile_base = None  # drawing id the client's tiles are relative to (see set_tiles)
+        self.current_room = None
+        self.strokes = StrokeHistory()  # what this player drew during the current round
+        self.protocol_version = handshake.LEGACY_VERSION
+        self.compressor = None  # compression.FrameCompressor when the client agreed on compression
+        self.tiles_task = None  # set_tiles of the last drawing_tiles, a newer upload cancels it
+        self.outbound = AsyncOutboundQueue(**OUTBOUND_POLICY)
+
+    async def write_loop(self):
+        #drains the outbound queue, drain() waits for the socket so a slow client only stalls itself
+        try:
+            while True:
+                batch = await self.outbound.get_batch()
+                if batch is None:
+                    break
+                self.writer.writelines(batch)
+                BYTES_OUT.inc(sum(map(len, batch)))
+                await self.writer.drain()
+        except Exception as e:
+            self.outbound.close(f"send failed: {e}")
+
+        if self.outbound.close_reason:
+            log.warning('client_dropped', name=self.name, reason=self.outbound.close_reason)
+        #closing the transport ends the read loop too
+        self.writer.close()
+
+    async def shake_hands(self):
+        #the username and what the client supports (handshake.py), False if that went wrong
+        try:
+            self.name, self.protocol_version, method = await handshake.accept_async(self.reader, self.writer)
+        except Exception as e:
+            log.warning('handshake_failed', error=e)
+            return False
+        self.compressor = compression.frame_compressor(method)
+        log.info('client_registered', name=self.name, version=self.protocol_version, compression=method)
+        return True
+
+    async def run(self):
+        try:
+            # greetings
+            self.send({'type': 'system', 'data': f"Hello, {self.name}! Use /room <room_id> to join a room."})
+            self.send_history(self.server.chat_history)
+
+            # "meet-a-new-user" message
+            self.broadcast({'type': 'system', 'data': f"{self.name} joined the chat!"}, include_self=True)
+
+            # main loop
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+                BYTES_IN.inc(HEADER.size + len(frame))
+                try:
+                    message = decode(frame)
+                    MESSAGES.inc(label=metrics.message_type(message))
+                    self.process_message(message)
+                except Exception as e:
+                    DECODE_FAILURES.inc()
+                    log.warning('bad_message', name=self.name, error=e)
+
+        except Exception as e:
+            log.warning('client_error', name=self.name, error=e)
+
+    def close(self):
+        self.outbound.close()
+        self.cancel_tiles()
+        self.clear_drawing()
+        self.set_tile_base(None)
+        self.leave_room()
+        # informing others about person who leaves the chat
+        self.broadcast({'type': 'system', 'data': f"{self.name} left the chat!"}, include_self=False)
+        self.server.remove_empty_rooms()
+        self.writer.close()
+        log.info('client_disconnected', name=self.name)
+
+    def send_frame(self, frame, kind='other'):
+        #never waits, the writer task sends it when the socket is ready
+        if self.compressor is not None:
+            frame = self.compressor.frame(frame, skip=kind == DRAWING)
+        return self.outbound.put(frame, kind)
+
+    def send(self, message):
+        return self.send_frame(encode_frame(message), message_kind(message.get('type')))
+
+    def send_history(self, history):
+        #the last messages in one frame, for clients that know chat_history
+        frame = history.frame()
+        if frame is not None and self.protocol_version >= handshake.HISTORY_VERSION:
+            self.send_frame(frame, CHAT)
+
+    def set_drawing(self, data):
+        #the store keeps the bytes (once per content), the handler only keeps the id
+        old_drawing = self.current_drawing
+        self.current_drawing = self.server.drawings.put(data)
+        self.server.drawings.release(old_drawing)
+        if self.server.drawings.pending:
+            self.server.spawn(self.server.flush_drawings())
+
+    def clear_drawing(self):
+        self.server.drawings.release(self.current_drawing)
+        self.current_drawing = None
+
+    def set_tile_base(self, key):
+        #the drawing the client's next tiles are relative to, kept in the store until it moves on
+        old_base = self.tile_base
+        self.tile_base = key if key is not None and self.server.drawings.retain(key) else None
+        self.server.drawings.release(old_base)
+
+    def cancel_tiles(self):
+        #a png still being built from older tiles must not replace a newer upload
+        if self.tiles_task is not None:
+            self.tiles_task.cancel()
+            self.tiles_task = None
+
+    async def set_tiles(self, base, payload):
+        #changed tiles on top of a drawing we both know (tiles.py), the result is a normal png.
+        #building the png takes a few ms of zlib, that runs in a worker thread and not in the loop
+        loop = asyncio.get_running_loop()
+        try:
+            base_png = None
+            if base is not None:
+                if base != self.tile_base:
+                    raise TileError("Unknown tile base")
+                #may have to be read back from the spill file
+                base_png = await loop.run_in_executor(None, self.server.drawings.get, base)
+                if base_png is None:
+                    raise TileError("Tile base is gone")
+            drawing = await loop.run_in_executor(None, apply_tiles, base_png, payload)
+        except TileError as e:
+            #the client starts over from a white canvas
+            log.warning('tiles_rejected', name=self.name, error=e)
+            self.send({'type': 'tiles_ack', 'data': {'given': None}})
+            return
+        if self.outbound.closed:
+            return  # gone while the png was built
+        self.set_drawing(drawing)
+        self.set_tile_base(self.current_drawing)
+        self.send({'type': 'tiles_ack', 'data': {'given': self.current_drawing}})
+
+    def has_drawing(self):
+        #the store may have dropped it when it ran out of memory
+        return self.current_drawing is not None and self.server.drawings.has(self.current_drawing)
+
+    def broadcast(self, message, include_self=False):
+        #sends messages to everyone, the message is encoded only once (for all workers)
+        exclude = None if include_self else self
+        self.broadcast_frame(encode_frame(message), message_kind(message.get('type')), exclude)
+
+    def broadcast_frame(self, frame, kind, exclude=None):
+        recipients = [client for client in self.server.clients.values() if client is not exclude]
+        fan_out(frame, recipients, kind)
+        if self.server.link:
+            self.server.link.broadcast(frame, kind)
+
+    def broadcast_to_room(self, message, include_self=False):
+        #sends messages to everyone in the same room
+        room = self.server.rooms.get(self.current_room)
+        if room:
+            recipients = [client for client in room.clients if client is not self or include_self]
+            fanout.broadcast(message, recipients)
+
+    def leave_room(self):
+        if self.server.link and self.current_room is not None:
+            self.server.link.leave(self.client_id)
+        if self.remote_home is not None:
+            #the room is on another worker, it forgets our RemoteClient there
+            self.server.link.send_to(self.remote_home, 'detach', {'client': self.client_id})
+            self.remote_home = None
+            self.current_room = None
+            return
+        self.leave_local_room()
+        self.server.remove_empty_rooms()
+
+    def leave_local_room(self):
+        room = self.server.rooms.get(self.current_room)
+        if room:
+            room_id = self.current_room
+            room.remove_client(self)
+            if not room.clients:
+                self.server.empty_rooms.add(room_id)
+
+            # notify the one who stayed
+            leave_msg = {'type': 'system', 'data': f"{self.name} left room {room_id}"}
+            fan_out(encode_frame(leave_msg), room.clients)
+
+            log.info('room_left', name=self.name, room=room_id)
+
+    def chat_message(self, text):
+        return {
+            'type': 'chat',
+            'data': {
+                'text': text,
+                'username': self.name,
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            }
+        }
+
+    @profiling.message_span
+    def process_message(self, message):
+        msg_type = message.get('type')
+        data = message.get('data')
+
+        if self.remote_home is not None and msg_type != 'join_room':
+            #the room lives on another worker, our RemoteClient there handles everything
+            self.server.link.send_to(self.remote_home, 'client_msg', {'client': self.client_id, 'message': message})
+            return
+
+        if msg_type == 'chat':
+            #encoded once, the same frame goes to the history for the ones who come later
+            frame = encode_frame(self.chat_message(data))
+            if self.current_room:
+                # send to room only
+                room = self.server.rooms.get(self.current_room)
+                if room:
+                    room.history.add(frame)
+                    fan_out(frame, room.clients, CHAT)
+            else:
+                # send to everyone (global chat)
+                self.server.chat_history.add(frame)
+                self.broadcast_frame(frame, CHAT)
+
+        elif msg_type == 'drawing_ready':
+            # saving a drawing for exchange
+            self.cancel_tiles()
+            self.set_drawing(data)
+            log.debug('drawing_received', name=self.name, room=self.current_room)
+
+        elif msg_type == 'drawing_tiles':
+            # only the tiles that changed, the server builds the png
+            self.cancel_tiles()
+            self.tiles_task = self.server.spawn(self.set_tiles(data['base'], data['tiles']))
+
+        elif msg_type == 'strokes':
+            room = self.server.rooms.get(self.current_room)
+            batch = data['strokes']
+            validate(batch)
+            if room and room.add_strokes(self, data['round'], batch):
+                #live strokes for the other player, so they can watch
+                stroke_msg = {'type': 'strokes', 'data': {'username': self.name, 'strokes': batch}}
+                self.broadcast_to_room(stroke_msg, include_self=False)
+
+        elif msg_type == 'join_room':
+            self.leave_room()  # leave current room if it exists
+            if self.server.link:
+                self.server.spawn(self.join_shared_room(data))
+            else:
+                self.enter_room(data)
+
+    async def join_shared_room(self, room_id):
+        #multi-process mode: the broker knows the rooms of all workers
+        home = await self.server.link.join(room_id, self.client_id)
+        if home is None:
+            self.send({'type': 'error', 'data': f"Room {room_id} is full (max 2 players)"})
+        elif self.outbound.closed:
+            self.server.link.leave(self.client_id)  # gone while we waited
+        elif home == self.server.worker:
+            self.enter_room(room_id)
+        else:
+            self.remote_home = home
+            self.current_room = room_id
+            self.server.link.send_to(home, 'attach', {'client': self.client_id, 'name': self.name,
+                                                      'version': self.protocol_version,
+                                                      'worker': self.server.worker, 'room': room_id})
+
+    def enter_room(self, room_id):
+        room = self.server.get_or_create_room(room_id)
+
+        if room.add_client(self):
+            # successfully joined the room!!
+            self.server.empty_rooms.discard(room_id)
+            self.send({'type': 'room_joined', 'data': room_id})
+            self.send_history(room.history)
+
+            #notify room members
+            self.broadcast_to_room({'type': 'system', 'data': f"{self.name} joined room {room_id}"}, include_self=True)
+
+            log.info('room_joined', name=self.name, room=room_id)
+
+            # check if room is full and start timer
+            if room.is_full():
+                full_msg = {'type': 'room_full', 'data': room_id}
+                fan_out(encode_frame(full_msg), room.clients)
+                room.start_timer()
+        else:
+            # when somebody tryna access the room that is full
+            self.send({'type': 'error', 'data': f"Room {room_id} is full (max 2 players)"})
+
+
+class RemoteClient(ClientHandler):
+    #a player connected to another worker, sitting in a room that lives here.
+    #its messages come in through the broker and everything it is sent goes back the same way
+    __slots__ = ('worker',)
+
+    def __init__(self, server, client_id, name, worker):
+        super().__init__(None, None, server, client_id)
+        self.name = name
+        self.worker = worker
+
+    def send_frame(self, frame, kind='other'):
+        self.server.link.send_to(self.worker, 'deliver', {'client': self.client_id, 'frame': frame, 'kind': kind})
+        return True
+
+    def broadcast_frame(self, frame, kind, exclude=None):
+        #global messages are sent by the worker the player is connected to
+        pass
+
+    def leave_room(self):
+        #the broker already knows, only the room here has to let go
+        self.leave_local_room()
+
+    def detach(self):
+        self.outbound.close()
+        self.leave_local_room()
+        self.clear_drawing()
+        self.set_tile_base(None)
+        self.server.remove_empty_rooms()
+
+
+class Server:
+    def __init__(self, address: str, port: int, worker=0, broker_path=None):
+        self.address = address
+        self.port = port
+        self.worker = worker  # number of this process in multi-process mode
+        self.client_ids = itertools.count(1)
+        self.clients = {}  # client id -> ClientHandler, dict so that removal is O(1)
+        self.remote_clients = {}  # client id -> RemoteClient (players of other workers in our rooms)
+        self.rooms = {}  # room_id to RoomHandler object
+        self.empty_rooms = set()  # room ids without members, removed by remove_empty_rooms
+        self.chat_history = ChatHistory()  # last messages of the global chat (of all workers)
+        #spilled drawings are written by flush_drawings in a worker thread, not by put in the loop
+        self.drawings = DrawingStore(DRAWING_MEMORY_BUDGET, DRAWING_SPILL_PATH, flush_on_put=False)
+        archive_dir = os.path.join(ARCHIVE_DIR, f"worker-{worker}") if ARCHIVE_DIR and broker_path else ARCHIVE_DIR
+        self.archive = DrawingArchive(archive_dir) if archive_dir else None
+        self.link = BrokerLink(self, worker, broker_path) if broker_path else None
+        self.loop = None
+        self.tasks = set()  # background tasks, the loop itself only keeps weak references to them
+
+    def spawn(self, coroutine):
+        #runs the coroutine as a task that can't be garbage collected before it is done
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error('task_failed', task=task.get_coro().__qualname__, error=repr(task.exception()))
+
+    async def flush_drawings(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.drawings.flush)
+
+    def new_client_id(self):
+        #unique over all workers
+        return f"{self.worker}:{next(self.client_ids)}"
+
+    async def handle_connection(self, reader, writer):
+        CONNECTIONS.inc()
+        log.info('client_connected', address=writer.get_extra_info('peername'))
+        client = ClientHandler(reader, writer, self)
+        self.clients[client.client_id] = client
+        write_task = None
+        try:
+            #the writer starts after the handshake, the answer to the hello goes out first
+            if await client.shake_hands():
+                write_task = asyncio.create_task(client.write_loop())
+                await client.run()
+        finally:
+            self.clients.pop(client.client_id, None)
+            client.close()
+            if write_task is not None:
+                await write_task
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        if self.link:
+            await self.link.connect()
+        self.add_metrics()
+        #with workers every process has its own listening socket on the same port,
+        #the kernel spreads the new connections over them
+        server = await asyncio.start_server(self.handle_connection, self.address, self.port,
+                                            backlog=ACCEPT_BACKLOG, reuse_port=self.link is not None)
+        log.info('server_started', address=f"{self.address}:{self.port}", worker=self.worker)
+        async with server:
+            await server.serve_forever()
+
+    def archive_drawing(self, room_id, author, receiver):
+        #keeps a copy of the exchanged drawing on disk for the gallery / replay
+        if self.archive is None or author.current_drawing is None:
+            return
+        drawing = self.drawings.get(author.current_drawing)
+        if drawing is not None:
+            self.archive.append(room_id, author.name, receiver.name, drawing)
+
+    def add_metrics(self):
+        #gauges are read from the live state when somebody asks for the metrics (from the http
+        #thread, list() copies the dict in one go)
+        metrics.gauge('drawer_clients', "Connected clients", lambda: len(self.clients))
+        metrics.gauge('drawer_rooms', "Open rooms", lambda: len(self.rooms))
+        metrics.gauge('drawer_outbound_frames', "Frames waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[0] for client in list(self.clients.values())))
+        metrics.gauge('drawer_outbound_bytes', "Bytes waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[1] for client in list(self.clients.values())))
+        metrics.gauge('drawer_drawings_stored', "Drawings in the drawing store", lambda: self.drawings.stats()['drawings'])
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT + self.worker)
+        if METRICS_DUMP_PATH:
+            metrics.dump_every(f"{METRICS_DUMP_PATH}.{self.worker}" if self.link else METRICS_DUMP_PATH)
+
+    def queue_depths(self):
+        #how much is waiting for every client: {name: (frames, bytes)}
+        return {client.name: client.outbound.depth() for client in self.clients.values()}
+
+    def get_or_create_room(self, room_id):
+        if room_id not in self.rooms:
+            self.rooms[room_id] = RoomHandler(room_id, self.loop)
+            self.empty_rooms.add(room_id)
+        return self.rooms[room_id]
+
+    def remove_empty_rooms(self):
+        #only the rooms that lost their last member, not a scan of all rooms
+        for room_id in self.empty_rooms:
+            room = self.rooms.get(room_id)
+            if room is not None and not room.clients:
+                self.rooms.pop(room_id).cancel_timer()
+        self.empty_rooms.clear()
+
+    def handle_peer(self, message):
+        #a message from another worker (through the broker)
+        msg_type = message['type']
+        data = message['data']
+        if msg_type == 'deliver':
+            #a frame for one of our players, from the room it sits in on another worker
+            client = self.clients.get(data['client'])
+            if client:
+                client.send_frame(data['frame'], data['kind'])
+        elif msg_type == 'broadcast':
+            if data['kind'] == CHAT:
+                self.chat_history.add(data['frame'])  # global chat of another worker
+            fan_out(data['frame'], list(self.clients.values()), data['kind'])
+        elif msg_type == 'attach':
+            client = RemoteClient(self, data['client'], data['name'], data['worker'])
+            client.protocol_version = data.get('version', handshake.LEGACY_VERSION)
+            self.remote_clients[client.client_id] = client
+            client.enter_room(data['room'])
+        elif msg_type == 'client_msg':
+            client = self.remote_clients.get(data['client'])
+            if client:
+                try:
+                    client.process_message(data['message'])
+                except Exception as e:
+                    DECODE_FAILURES.inc()
+                    log.warning('bad_message', name=client.name, error=e)
+        elif msg_type == 'detach':
+            client = self.remote_clients.pop(data['client'], None)
+            if client:
+                client.detach()
+
+
+def run_worker(worker, host, port, broker_path, profile=None):
+    profiling.install(profile, f".worker-{worker}")
+    try:
+        asyncio.run(Server(host, port, worker, broker_path).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        profiling.stop()  # worker processes end without running atexit
+
+
+def run_workers(host, port, workers, broker_path=broker.BROKER_PATH, profile=None):
+    #one broker process and N worker processes, all on the same port
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("--workers needs SO_REUSEPORT (linux / bsd)")
+    if os.path.exists(broker_path):
+        os.remove(broker_path)  # left over from the last run
+    broker_process = Process(target=broker.serve, args=(broker_path,), daemon=True)
+    broker_process.start()
+    while not os.path.exists(broker_path):
+        if not broker_process.is_alive():
+            raise SystemExit("The broker did not start")
+        broker_process.join(0.05)
+    processes = [Process(target=run_worker, args=(worker, host, port, broker_path, profile), daemon=True)
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        log.info('server_stopped')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="asyncio server for the room game")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9003)
+    parser.add_argument('--workers', type=int, default=1, help="processes accepting on the port (SO_REUSEPORT)")
+    parser.add_argument('--profile', default=profiling.PROFILE_PATH, metavar='PATH',
+                        help="sample the server and write PATH.folded / PATH.spans.folded (see profiling.py)")
+    args = parser.parse_args()
+    if args.workers > 1:
+        run_workers(args.host, args.port, args.workers, profile=args.profile)
+    else:
+        profiling.install(args.profile)
+        try:
+            asyncio.run(Server(args.host, args.port).serve())
+        except KeyboardInterrupt:
+            log.info('server_stopped')
@@ -0,0 +1,75 @@
+import socket
+from collections import deque
+from queue import Empty
+from threading import Lock
+
+#client side sending: the send thread wakes up for a message, takes everything else that is
+#queued by then and writes it all with one sendall (a few fast chat lines = one packet, not one each).
+#with nagle off (TCP_NODELAY) a lone message goes out right away instead of waiting for the ack
+#of the one before, the batching is what keeps the packet count down
+
+MAX_BATCH_BYTES = 256 * 1024  # stop taking more messages, a drawing doesn't hold up the chat behind it
+LATENCY_WINDOW = 200  # last messages the percentiles are taken over
+EXIT = "EXIT"  # put in the queue to stop the send thread
+
+
+def no_delay(sock):
+    #turn off nagle, the batching already merges small writes
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass  # not tcp (e.g. a socketpair in tests)
+
+
+def drain(queue, first, max_bytes=MAX_BATCH_BYTES):
+    #first = (frame, queued at) the thread woke up for, returns the batch and whether EXIT came
+    batch = [first]
+    size = len(first[0])
+    while size < max_bytes:
+        try:
+            item = queue.get_nowait()
+        except Empty:
+            break
+        if item == EXIT:
+            return batch, True
+        batch.append(item)
+        size += len(item[0])
+    return batch, False
+
+
+class SendStats:
+    #what the send thread did: messages, writes (~ packets for small ones), bytes and how long
+    #messages waited between send_message() and the end of their write
+    def __init__(self):
+        self.lock = Lock()
+        self.messages = 0
+        self.writes = 0
+        self.bytes = 0
+        self.largest_batch = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # seconds
+        self.max_latency = 0.0
+
+    def record(self, batch, size, sent_at):
+        with self.lock:
+            self.messages += len(batch)
+            self.writes += 1
+            self.bytes += size
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for _, queued_at in batch:
+                latency = sent_at - queued_at
+                self.latencies.append(latency)
+                self.max_latency = max(self.max_latency, latency)
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'messages': self.messages, 'writes': self.writes, 'bytes': self.bytes,
+                     'largest_batch': self.largest_batch, 'max_ms': round(self.max_latency * 1000, 2)}
+        stats['per_write'] = round(stats['messages'] / stats['writes'], 2) if stats['writes'] else 0
+        if latencies:
+            stats['p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 2)
+            stats['p99_ms'] = round(latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000, 2)
+        return stats
+
+    def summary(self):
+        return ', '.join(f"{key} {value}" for key, value in self.snapshot().items())
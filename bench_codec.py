@@ -0,0 +1,48 @@
+import base64
+import os
+import sys
+import timeit
+from codec import get_codec
+
+#encode/decode cost and frame size: binary codec vs the old pickle path
+#usage: python bench_codec.py [iterations]
+
+PNG_SIZE = 60 * 1024  # a typical 600x600 canvas with some drawing on it
+
+
+def sample_messages():
+    png = os.urandom(PNG_SIZE)  # random bytes do not compress, like a real png
+    return {
+        'chat': {'type': 'chat', 'data': {'text': 'hello there, nice drawing!',
+                                          'username': 'player42', 'timestamp': '12:34:56'}},
+        'system': {'type': 'system', 'data': 'player42 joined the chat!'},
+        'join_room': {'type': 'join_room', 'data': '17'},
+        'drawing_exchange (base64)': {'type': 'drawing_exchange',
+                                      'data': {'image_data': base64.b64encode(png).decode('utf-8'),
+                                               'username': 'player42'}},
+        'drawing_exchange (raw)': {'type': 'drawing_exchange',
+                                   'data': {'image_data': png, 'username': 'player42'}},
+    }
+
+
+def bench(codec, message, iterations):
+    payload = codec.encode(message)
+    encode_time = timeit.timeit(lambda: codec.encode(message), number=iterations) / iterations
+    decode_time = timeit.timeit(lambda: codec.decode(payload), number=iterations) / iterations
+    return len(payload), encode_time * 1e6, decode_time * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    codecs = [get_codec('pickle'), get_codec('binary')]
+    print(f"{'message':<28}{'codec':<8}{'bytes':>9}{'encode us':>12}{'decode us':>12}")
+    for label, message in sample_messages().items():
+        #big payloads are slow enough already, no need for the full count
+        count = iterations if 'drawing' not in label else max(iterations // 100, 10)
+        for codec in codecs:
+            size, enc, dec = bench(codec, message, count)
+            print(f"{label:<28}{codec.name:<8}{size:>9}{enc:>12.2f}{dec:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
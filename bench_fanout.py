@@ -0,0 +1,66 @@
+import sys
+import time
+import codec
+import fanout
+
+#broadcast cost vs number of clients: encode-per-client (old) vs encode-once (fanout.py)
+#clients are fake, send_frame just keeps a reference like a real outbound queue would
+#usage: python bench_fanout.py [rounds]
+
+
+class FakeClient:
+    def __init__(self):
+        self.frame = None
+
+    def send_frame(self, frame, kind=None):
+        self.frame = frame
+        return True
+
+
+class CountingEncoder:
+    #wraps codec.encode_frame so we can count how many times a broadcast serializes
+    def __init__(self):
+        self.calls = 0
+        self.encode_frame = codec.encode_frame
+
+    def __call__(self, message):
+        self.calls += 1
+        return self.encode_frame(message)
+
+
+def old_broadcast(message, recipients, encode_frame):
+    for client in recipients:
+        client.send_frame(encode_frame(message))
+
+
+def measure(func, message, clients, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(message, clients)
+    return (time.perf_counter() - start) / rounds * 1e3
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    message = {'type': 'chat', 'data': {'text': 'hello everybody!', 'username': 'player42',
+                                        'timestamp': '12:34:56'}}
+    counter = CountingEncoder()
+    codec.encode_frame = counter  # count the encodes done by the real fan-out path
+
+    print(f"{'clients':>8}{'old ms':>10}{'encodes':>9}{'once ms':>10}{'encodes':>9}")
+    for count in (10, 100, 1000, 10000):
+        clients = [FakeClient() for _ in range(count)]
+
+        counter.calls = 0
+        old_ms = measure(lambda m, c: old_broadcast(m, c, counter), message, clients, rounds)
+        old_calls = counter.calls // rounds
+
+        counter.calls = 0
+        once_ms = measure(fanout.broadcast, message, clients, rounds)
+        once_calls = counter.calls // rounds
+
+        print(f"{count:>8}{old_ms:>10.3f}{old_calls:>9}{once_ms:>10.3f}{once_calls:>9}")
+
+
+if __name__ == '__main__':
+    main()
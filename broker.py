@@ -0,0 +1,161 @@
+import asyncio
+import os
+from codec import decode, encode_frame
+import log
+from protocol import read_frame
+
+#local message bus for the multi-process mode of async_server.py (python async_server.py --workers N)
+#every worker process connects over a unix socket. the broker decides who is in which room,
+#and every room lives on one worker (its home, where the first player joined). a player that
+#landed on another worker is attached to the home worker as a RemoteClient, their messages and
+#the frames for them go through the broker.
+#
+#worker -> broker: hello, join (answered with join_result), leave, forward (to one worker), broadcast
+#broker -> worker: join_result, the forwarded messages, broadcast
+
+BROKER_PATH = '/tmp/drawer-broker.sock'
+ROOM_SIZE = 2
+
+
+class Broker:
+    def __init__(self, path=BROKER_PATH):
+        self.path = path
+        self.workers = {}  # worker number -> StreamWriter
+        self.rooms = {}  # room id -> [home worker, set of client ids]
+        self.client_rooms = {}  # client id -> room id
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self.handle_worker, self.path)
+        log.info('broker_started', path=self.path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_worker(self, reader, writer):
+        worker = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                message = decode(frame)
+                msg_type = message['type']
+                data = message['data']
+                if msg_type == 'hello':
+                    worker = data
+                    self.workers[worker] = writer
+                    log.info('worker_connected', worker=worker)
+                elif msg_type == 'join':
+                    home = self.join(data['room'], data['client'], worker)
+                    writer.write(encode_frame({'type': 'join_result', 'data': {'client': data['client'], 'home': home}}))
+                elif msg_type == 'leave':
+                    self.leave(data['client'])
+                elif msg_type == 'forward':
+                    self.send(data['to'], data['message'])
+                elif msg_type == 'broadcast':
+                    frame = encode_frame(message)
+                    for number, other in self.workers.items():
+                        if number != worker:
+                            other.write(frame)
+        except Exception as e:
+            log.error('broker_failed', worker=worker, error=e)
+        finally:
+            if worker is not None:
+                log.info('worker_left', worker=worker)
+                self.workers.pop(worker, None)
+                #its players are gone too
+                for client_id in [c for c in self.client_rooms if c.startswith(f"{worker}:")]:
+                    self.leave(client_id)
+            writer.close()
+
+    def join(self, room_id, client_id, worker):
+        #returns the home worker of the room, or None if it is full
+        self.leave(client_id)
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = [worker, set()]
+        if len(room[1]) >= ROOM_SIZE:
+            return None
+        room[1].add(client_id)
+        self.client_rooms[client_id] = room_id
+        return room[0]
+
+    def leave(self, client_id):
+        room_id = self.client_rooms.pop(client_id, None)
+        if room_id is None:
+            return
+        members = self.rooms[room_id][1]
+        members.discard(client_id)
+        if not members:
+            del self.rooms[room_id]
+
+    def send(self, worker, message):
+        writer = self.workers.get(worker)
+        if writer is not None:
+            writer.write(encode_frame(message))
+
+
+class BrokerLink:
+    #the worker side of the bus
+    def __init__(self, server, worker, path=BROKER_PATH):
+        self.server = server
+        self.worker = worker
+        self.path = path
+        self.writer = None
+        self.pending = {}  # client id -> future waiting for join_result
+
+    async def connect(self, attempts=50):
+        #the broker may still be starting up
+        for attempt in range(attempts):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(0.1)
+        self.send('hello', self.worker)
+        self.server.spawn(self.read_loop(reader))  # kept alive and its errors logged by the server
+
+    def send(self, msg_type, data):
+        self.writer.write(encode_frame({'type': msg_type, 'data': data}))
+
+    async def join(self, room_id, client_id):
+        #returns the home worker of the room, or None if it is full
+        future = asyncio.get_running_loop().create_future()
+        self.pending[client_id] = future
+        self.send('join', {'room': room_id, 'client': client_id})
+        return await future
+
+    def leave(self, client_id):
+        self.send('leave', {'client': client_id})
+
+    def send_to(self, worker, msg_type, data):
+        self.send('forward', {'to': worker, 'message': {'type': msg_type, 'data': data}})
+
+    def broadcast(self, frame, kind):
+        #a frame for every client on the other workers
+        self.send('broadcast', {'frame': frame, 'kind': kind})
+
+    async def read_loop(self, reader):
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                log.error('broker_lost', worker=self.worker)
+                return
+            message = decode(frame)
+            if message['type'] == 'join_result':
+                future = self.pending.pop(message['data']['client'], None)
+                if future and not future.done():
+                    future.set_result(message['data']['home'])
+            else:
+                self.server.handle_peer(message)
+
+
+def serve(path=BROKER_PATH):
+    #entry point of the broker process
+    try:
+        asyncio.run(Broker(path).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,39 @@
+from collections import deque
+from threading import Lock
+from codec import encode_frame
+
+#recent chat for the players who come in later: the last messages of a room (or of the global
+#chat) are kept as the very frames that were broadcast. a newcomer gets them all in one
+#chat_history frame, data = those frames one after the other (the client splits them up like
+#the socket stream). nothing is encoded again, and the history frame is built once per new message
+
+HISTORY_SIZE = 50  # messages per room
+HISTORY_BYTES = 64 * 1024  # per room, a few long messages push the old ones out sooner
+
+
+class ChatHistory:
+    def __init__(self, size=HISTORY_SIZE, max_bytes=HISTORY_BYTES):
+        self.lock = Lock()
+        self.frames = deque(maxlen=size)  # ring buffer of chat frames, oldest first
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.cached = None  # the chat_history frame, until the next message comes in
+
+    def add(self, frame):
+        if len(frame) > self.max_bytes:
+            return  # would push out everything else
+        with self.lock:
+            if len(self.frames) == self.frames.maxlen:
+                self.bytes -= len(self.frames[0])  # the deque drops it on append
+            self.frames.append(frame)
+            self.bytes += len(frame)
+            while self.bytes > self.max_bytes:
+                self.bytes -= len(self.frames.popleft())
+            self.cached = None
+
+    def frame(self):
+        #the catch-up frame for a newcomer, None if nobody said anything yet
+        with self.lock:
+            if self.cached is None and self.frames:
+                self.cached = encode_frame({'type': 'chat_history', 'data': b''.join(self.frames)})
+            return self.cached
@@ -0,0 +1,292 @@
+import pickle
+import struct
+import compression
+from protocol import HEADER, ProtocolError, pack_frame
+
+#message codecs for the {'type': ..., 'data': ...} envelope
+#
+#binary layout: [type tag byte][value]
+#value = [kind byte][payload], lengths and ints are varints (7 bits per byte)
+#bytes are carried raw, so images do not need base64 anymore
+#
+#the codec is pure python, so one message costs more cpu than the C pickle it replaced (see
+#bench_codec.py). that was traded for safety: decoding never runs code from the wire. the hot
+#path (control messages with a string and chat dicts of short strings) skips the generic value
+#walk, and the real savings are elsewhere: a broadcast is encoded once, images are not base64'd
+
+#one byte per message type, append new types at the end (the index is the wire tag)
+MESSAGE_TYPES = [
+    'system', 'error', 'chat', 'drawing_ready', 'drawing_exchange',
+    'join_room', 'room_joined', 'room_full', 'timer_start', 'strokes', 'stroke_exchange',
+    'drawing_tiles', 'tiles_ack', 'find_match', 'hello', 'chat_history',
+]
+TYPE_TAGS = {name: tag for tag, name in enumerate(MESSAGE_TYPES)}
+CUSTOM_TYPE = 0xFF  # type name follows as a string, 0xFD and 0xFE are compressed payloads (compression.py)
+
+#dict keys that show up in every message get a one byte index instead of the string
+KNOWN_KEYS = ['text', 'username', 'timestamp', 'image_data', 'round', 'strokes', 'accepted', 'given',
+              'base', 'tiles']
+KEY_TAGS = {name: tag + 1 for tag, name in enumerate(KNOWN_KEYS)}  # 0 means "string follows"
+
+NONE, TRUE, FALSE, INT, FLOAT, STR, BYTES, LIST, DICT = range(9)
+FLOAT_STRUCT = struct.Struct('!d')
+MAX_DEPTH = 16
+COMPRESSED_TAGS = frozenset(compression.TAGS.values())
+
+
+class CodecError(Exception):
+    pass
+
+
+def write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise CodecError("Truncated varint")
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise CodecError("Varint too long")
+
+
+class BinaryCodec:
+    name = 'binary'
+
+    def encode(self, message):
+        #control messages (system, error, join_room...) are one short string: no value walk
+        data = message.get('data')
+        if type(data) is str:
+            tag = TYPE_TAGS.get(message.get('type'))
+            if tag is not None:
+                raw = data.encode('utf-8')
+                if len(raw) < 0x80:
+                    return bytes((tag, STR, len(raw))) + raw
+        return bytes(self._encode(message, bytearray()))
+
+    def encode_frame(self, message):
+        #encodes right behind a reserved length prefix, so big images are not copied once more
+        out = self._encode(message, bytearray(HEADER.size))
+        HEADER.pack_into(out, 0, len(out) - HEADER.size)
+        return bytes(out)
+
+    def _encode(self, message, out):
+        msg_type = message.get('type')
+        tag = TYPE_TAGS.get(msg_type)
+        if tag is None:
+            out.append(CUSTOM_TYPE)
+            self._write_str(out, msg_type)
+        else:
+            out.append(tag)
+        self._write_value(out, message.get('data'), 0)
+        return out
+
+    def decode(self, payload):
+        #slicing bytes gives bytes back, which is what the handlers want for image data
+        buf = payload if type(payload) is bytes else bytes(payload)
+        if not buf:
+            raise CodecError("Empty message")
+        if buf[0] in COMPRESSED_TAGS:
+            #only sent to / by clients that agreed on it in the handshake
+            try:
+                buf = compression.decompress(buf)
+            except ProtocolError as e:
+                raise CodecError(str(e)) from e  # a corrupt message, same as any other bad payload
+            if not buf:
+                raise CodecError("Empty message")
+        tag = buf[0]
+        pos = 1
+        if tag == CUSTOM_TYPE:
+            msg_type, pos = self._read_str(buf, pos)
+        elif tag < len(MESSAGE_TYPES):
+            msg_type = MESSAGE_TYPES[tag]
+        else:
+            raise CodecError(f"Unknown message type tag {tag}")
+        #short string data: the control messages
+        if len(buf) > pos + 1 and buf[pos] == STR and buf[pos + 1] < 0x80 and len(buf) == pos + 2 + buf[pos + 1]:
+            try:
+                return {'type': msg_type, 'data': buf[pos + 2:].decode('utf-8')}
+            except UnicodeDecodeError:
+                raise CodecError("Invalid utf-8 string")
+        data, pos = self._read_value(buf, pos, 0)
+        if pos != len(buf):
+            raise CodecError("Trailing bytes after message")
+        return {'type': msg_type, 'data': data}
+
+    def _write_str(self, out, value):
+        raw = value.encode('utf-8')
+        length = len(raw)
+        if length < 0x80:
+            out.append(length)  # the usual case, one byte length
+        else:
+            write_varint(out, length)
+        out += raw
+
+    def _write_value(self, out, value, depth):
+        if depth > MAX_DEPTH:
+            raise CodecError("Message nested too deep")
+        #exact type checks are a lot faster than isinstance chains
+        kind = type(value)
+        if kind is str:
+            out.append(STR)
+            self._write_str(out, value)
+        elif kind is dict:
+            out.append(DICT)
+            write_varint(out, len(value))
+            for key, item in value.items():
+                key_tag = KEY_TAGS.get(key)
+                if key_tag is None:
+                    out.append(0)
+                    self._write_str(out, key)
+                else:
+                    out.append(key_tag)
+                if type(item) is str:
+                    #most dict values are short strings (chat), written right here
+                    raw = item.encode('utf-8')
+                    if len(raw) < 0x80:
+                        out.append(STR)
+                        out.append(len(raw))
+                        out += raw
+                        continue
+                self._write_value(out, item, depth + 1)
+        elif kind is bytes or kind is bytearray or kind is memoryview:
+            out.append(BYTES)
+            write_varint(out, len(value))
+            out += value
+        elif value is None:
+            out.append(NONE)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif kind is int:
+            out.append(INT)
+            #zigzag so that small negative numbers stay small
+            write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif kind is float:
+            out.append(FLOAT)
+            out += FLOAT_STRUCT.pack(value)
+        elif kind is list or kind is tuple:
+            out.append(LIST)
+            write_varint(out, len(value))
+            for item in value:
+                self._write_value(out, item, depth + 1)
+        else:
+            raise CodecError(f"Cannot encode {kind.__name__}")
+
+    def _read_str(self, buf, pos):
+        length, pos = read_varint(buf, pos)
+        end = pos + length
+        if end > len(buf):
+            raise CodecError("Truncated message")
+        try:
+            return buf[pos:end].decode('utf-8'), end
+        except UnicodeDecodeError:
+            raise CodecError("Invalid utf-8 string")
+
+    def _read_value(self, buf, pos, depth):
+        if depth > MAX_DEPTH:
+            raise CodecError("Message nested too deep")
+        if pos >= len(buf):
+            raise CodecError("Truncated message")
+        kind = buf[pos]
+        pos += 1
+        if kind == STR:
+            return self._read_str(buf, pos)
+        if kind == DICT:
+            count, pos = read_varint(buf, pos)
+            result = {}
+            for _ in range(count):
+                if pos >= len(buf):
+                    raise CodecError("Truncated message")
+                key_tag = buf[pos]
+                pos += 1
+                if key_tag == 0:
+                    key, pos = self._read_str(buf, pos)
+                elif key_tag <= len(KNOWN_KEYS):
+                    key = KNOWN_KEYS[key_tag - 1]
+                else:
+                    raise CodecError(f"Unknown key tag {key_tag}")
+                if pos + 1 < len(buf) and buf[pos] == STR and buf[pos + 1] < 0x80:
+                    #short string value, read right here
+                    end = pos + 2 + buf[pos + 1]
+                    if end > len(buf):
+                        raise CodecError("Truncated message")
+                    try:
+                        result[key] = buf[pos + 2:end].decode('utf-8')
+                    except UnicodeDecodeError:
+                        raise CodecError("Invalid utf-8 string")
+                    pos = end
+                    continue
+                result[key], pos = self._read_value(buf, pos, depth + 1)
+            return result, pos
+        if kind == BYTES:
+            length, pos = read_varint(buf, pos)
+            end = pos + length
+            if end > len(buf):
+                raise CodecError("Truncated message")
+            return buf[pos:end], end
+        if kind == NONE:
+            return None, pos
+        if kind == TRUE:
+            return True, pos
+        if kind == FALSE:
+            return False, pos
+        if kind == INT:
+            value, pos = read_varint(buf, pos)
+            return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+        if kind == FLOAT:
+            if pos + FLOAT_STRUCT.size > len(buf):
+                raise CodecError("Truncated message")
+            return FLOAT_STRUCT.unpack_from(buf, pos)[0], pos + FLOAT_STRUCT.size
+        if kind == LIST:
+            count, pos = read_varint(buf, pos)
+            result = []
+            for _ in range(count):
+                item, pos = self._read_value(buf, pos, depth + 1)
+                result.append(item)
+            return result, pos
+        raise CodecError(f"Unknown value kind {kind}")
+
+
+class PickleCodec:
+    #the old wire format, only kept for benchmarks and debugging
+    #never use it on sockets you don't trust: pickle.loads can run arbitrary code
+    name = 'pickle'
+
+    def encode(self, message):
+        return pickle.dumps(message)
+
+    def encode_frame(self, message):
+        return pack_frame(pickle.dumps(message))
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+
+CODECS = {codec.name: codec for codec in (BinaryCodec(), PickleCodec())}
+
+
+def get_codec(name='binary'):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec: {name}")
+
+
+#the codec both servers and clients use on the wire
+default_codec = get_codec('binary')
+encode = default_codec.encode
+encode_frame = default_codec.encode_frame
+decode = default_codec.decode
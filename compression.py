@@ -0,0 +1,103 @@
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from protocol import HEADER, MAX_FRAME_SIZE, ProtocolError, pack_frame
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zlib only
+
+#per-frame compression, agreed on in the handshake (handshake.py), legacy clients never get it.
+#a compressed payload is [tag byte][compressed codec payload], the tags are bytes the codec
+#never uses for a message type, so codec.decode unpacks them on its own.
+#frames that would not get smaller go out as they are, pngs are not even tried
+
+ZLIB = 'zlib'
+ZSTD = 'zstd'
+TAGS = {ZLIB: 0xFE, ZSTD: 0xFD}
+METHODS = [ZSTD, ZLIB] if zstandard else [ZLIB]  # what we support, the best first
+MIN_SIZE = 128  # smaller payloads don't get smaller
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+CACHE_SIZE = 64  # frames remembered by FrameCompressor
+#messages that carry pngs / zlib tiles, compressing them again only costs time
+PRECOMPRESSED_TYPES = {'drawing_ready', 'drawing_exchange', 'drawing_tiles'}
+
+DECOMPRESS_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard else ())
+
+_compressors = {}  # method -> FrameCompressor shared by all connections
+_compressors_lock = Lock()
+
+
+def is_compressed(payload):
+    return len(payload) > 0 and payload[0] in (TAGS[ZLIB], TAGS[ZSTD])
+
+
+def compress(payload, method):
+    #returns the compressed payload, or the payload itself if that is smaller
+    if len(payload) < MIN_SIZE:
+        return payload
+    if method == ZLIB:
+        body = zlib.compress(payload, ZLIB_LEVEL)
+    elif method == ZSTD and zstandard is not None:
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    else:
+        raise ValueError(f"Unknown compression {method}")
+    if len(body) + 1 >= len(payload):
+        return payload
+    return bytes((TAGS[method],)) + body
+
+
+def decompress(payload):
+    #never more than a frame can hold (zip bombs)
+    tag = payload[0]
+    try:
+        if tag == TAGS[ZLIB]:
+            inflater = zlib.decompressobj()
+            data = inflater.decompress(payload[1:], MAX_FRAME_SIZE)
+            if inflater.unconsumed_tail or not inflater.eof:
+                raise ProtocolError("Bad compressed frame")
+            return data
+        if tag == TAGS[ZSTD] and zstandard is not None:
+            return zstandard.ZstdDecompressor().decompress(payload[1:], max_output_size=MAX_FRAME_SIZE)
+    except DECOMPRESS_ERRORS as e:
+        raise ProtocolError(f"Bad compressed frame: {e}")
+    raise ProtocolError(f"Unsupported compression tag {tag}")
+
+
+class FrameCompressor:
+    #server side, whole frames (length prefix included). a broadcast hands the same frame
+    #object to every client, so the last frames are cached by identity and compressed only once
+    def __init__(self, method):
+        self.method = method
+        self.lock = Lock()
+        self.cache = OrderedDict()  # id(frame) -> (frame, compressed frame)
+
+    def frame(self, frame, skip=False):
+        #skip = the frame carries a png
+        if skip or len(frame) < HEADER.size + MIN_SIZE:
+            return frame
+        key = id(frame)
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] is frame:
+                return cached[1]
+        payload = compress(memoryview(frame)[HEADER.size:], self.method)
+        result = frame if len(payload) + HEADER.size >= len(frame) else pack_frame(payload)
+        with self.lock:
+            #the cache keeps the frame alive, so its id can't be reused meanwhile
+            self.cache[key] = (frame, result)
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return result
+
+
+def frame_compressor(method):
+    #None for uncompressed connections
+    if method is None:
+        return None
+    with _compressors_lock:
+        if method not in _compressors:
+            _compressors[method] = FrameCompressor(method)
+        return _compressors[method]
@@ -0,0 +1,210 @@
+import bisect
+import hashlib
+import os
+from collections import OrderedDict
+from threading import Lock
+
+#server side storage for the drawings waiting for an exchange
+#drawings are keyed by a hash of their bytes, so a blank canvas sent by 1000 players is kept once.
+#handlers only keep the id. when the memory budget is used up, the least recently used
+#drawings go to an on-disk segment file (or are dropped if there is no file).
+#the space of released drawings in the file is reused (free list), and the disk is only touched
+#outside of the store lock: evicted drawings wait in memory (pending) until flush() writes them
+
+MEMORY_BUDGET = 64 * 1024 * 1024  # 64 MB
+
+
+def drawing_id(data):
+    #the clients use it too, to know which of their pngs the server is talking about
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class DrawingStore:
+    def __init__(self, memory_budget=MEMORY_BUDGET, spill_path=None, flush_on_put=True):
+        self.memory_budget = memory_budget
+        self.lock = Lock()
+        self.memory = OrderedDict()  # id -> bytes, oldest first
+        self.memory_bytes = 0
+        self.refs = {}  # id -> how many handlers hold it
+        self.spilled = {}  # id -> (offset, length) in the segment file
+        self.pending = {}  # id -> (bytes, offset) evicted but not written yet
+        self.writing = {}  # id -> the pending entry a flush is writing right now
+        self.free = []  # [offset, length] holes in the segment file, sorted by offset
+        self.file_end = 0  # everything after it is free
+        self.file_size = 0  # what is really on disk, the file is cut to file_end on flush
+        self.flush_on_put = flush_on_put  # False: the caller runs flush() itself (e.g. in an executor)
+        self.spill_path = spill_path
+        self.spill_file = open(spill_path, 'w+b') if spill_path else None
+        self.io_lock = Lock()  # the file position is shared, reads and writes take turns on it
+        self.hits = 0
+        self.dedup_hits = 0
+        self.spill_reads = 0
+        self.evicted = 0
+
+    def put(self, data):
+        #stores a drawing (once per content) and returns its id, the caller owns one reference
+        key = drawing_id(data)
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.dedup_hits += 1
+            elif key in self.pending or key in self.spilled:
+                self.dedup_hits += 1
+            else:
+                self.memory[key] = bytes(data)
+                self.memory_bytes += len(data)
+                self._evict()
+        if self.flush_on_put and self.pending:
+            self.flush()
+        return key
+
+    def retain(self, key):
+        #one more reference to a stored drawing, returns False if it is gone
+        with self.lock:
+            if not self._has(key):
+                return False
+            self.refs[key] += 1
+            return True
+
+    def has(self, key):
+        #without reading a spilled drawing back
+        with self.lock:
+            return self._has(key)
+
+    def get(self, key):
+        #returns the bytes or None if the drawing is gone
+        while True:
+            with self.lock:
+                data = self.memory.get(key)
+                if data is not None:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return data
+                if key in self.pending:
+                    self.hits += 1
+                    return self.pending[key][0]
+                extent = self.spilled.get(key)
+                if extent is None:
+                    return None
+                self.spill_reads += 1
+            data = self._read(*extent)
+            with self.lock:
+                #released (and its space reused) while we were reading: look again, the content
+                #may have been put back and spilled somewhere else
+                if self.spilled.get(key) == extent:
+                    return data
+
+    def release(self, key):
+        #the handler doesn't need the drawing anymore
+        if key is None:
+            return
+        with self.lock:
+            count = self.refs.get(key, 0) - 1
+            if count > 0:
+                self.refs[key] = count
+                return
+            self.refs.pop(key, None)
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory_bytes -= len(data)
+            entry = self.pending.pop(key, None)
+            if entry is not None and self.writing.get(key) is not entry:
+                self._free(entry[1], len(entry[0]))  # a running flush frees it when it is done
+            extent = self.spilled.pop(key, None)
+            if extent is not None:
+                self._free(*extent)
+
+    def flush(self):
+        #writes the evicted drawings to the segment file, the store stays usable meanwhile
+        if not self.spill_file:
+            return
+        with self.lock:
+            batch = [(key, entry) for key, entry in self.pending.items() if key not in self.writing]
+            self.writing.update(batch)
+        with self.io_lock:
+            for _, (data, offset) in batch:
+                self.spill_file.seek(offset)
+                self.spill_file.write(data)
+                self.file_size = max(self.file_size, offset + len(data))
+            self.spill_file.flush()
+            with self.lock:
+                for key, entry in batch:
+                    del self.writing[key]
+                    data, offset = entry
+                    if self.pending.get(key) is entry:
+                        del self.pending[key]
+                        self.spilled[key] = (offset, len(data))
+                    else:
+                        self._free(offset, len(data))  # released while it was written
+                end = self.file_end
+            #under io_lock: nothing reserved after reading file_end can be written before the cut
+            if end < self.file_size:
+                self.spill_file.truncate(end)
+                self.file_size = end
+
+    def stats(self):
+        with self.lock:
+            return {
+                'drawings': len(self.memory) + len(self.pending) + len(self.spilled),
+                'memory_bytes': self.memory_bytes,
+                'spilled': len(self.pending) + len(self.spilled),
+                'spill_bytes': self.file_end,
+                'spill_free_bytes': sum(length for _, length in self.free),
+                'hits': self.hits,
+                'dedup_hits': self.dedup_hits,
+                'spill_reads': self.spill_reads,
+                'evicted': self.evicted,
+            }
+
+    def close(self):
+        with self.io_lock:
+            if self.spill_file:
+                self.spill_file.close()
+                os.remove(self.spill_path)
+                self.spill_file = None
+
+    def _has(self, key):
+        return key in self.memory or key in self.pending or key in self.spilled
+
+    def _evict(self):
+        while self.memory_bytes > self.memory_budget and len(self.memory) > 1:
+            key, data = self.memory.popitem(last=False)
+            self.memory_bytes -= len(data)
+            self.evicted += 1
+            #no spill file: the drawing is lost, the exchange will skip it. its references stay,
+            #the holders still release them and the same content may be put again meanwhile
+            if self.spill_file:
+                self.pending[key] = (data, self._reserve(len(data)))
+
+    def _reserve(self, length):
+        #first hole that is big enough, else the end of the file
+        for i, (offset, size) in enumerate(self.free):
+            if size >= length:
+                if size == length:
+                    del self.free[i]
+                else:
+                    self.free[i] = [offset + length, size - length]
+                return offset
+        offset = self.file_end
+        self.file_end += length
+        return offset
+
+    def _free(self, offset, length):
+        #gives the space back, merged with the holes next to it
+        i = bisect.bisect(self.free, [offset, length])
+        if i < len(self.free) and offset + length == self.free[i][0]:
+            length += self.free.pop(i)[1]
+        if i > 0 and self.free[i - 1][0] + self.free[i - 1][1] == offset:
+            i -= 1
+            offset = self.free[i][0]
+            length += self.free.pop(i)[1]
+        if offset + length == self.file_end:
+            self.file_end = offset  # a hole at the end is just a shorter file
+        else:
+            self.free.insert(i, [offset, length])
+
+    def _read(self, offset, length):
+        with self.io_lock:
+            self.spill_file.seek(offset)
+            return self.spill_file.read(length)
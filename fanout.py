@@ -0,0 +1,37 @@
+import time
+import codec
+import metrics
+import profiling
+from outbound import OTHER, message_kind
+
+#serialize-once fan-out: a message going to N clients is encoded one time,
+#and every recipient gets the very same immutable frame (bytes are never copied per client)
+
+FANOUT_TIME = metrics.histogram('drawer_fanout_ms', "Time to queue one frame to all its recipients")
+FANOUT_RECIPIENTS = metrics.counter('drawer_fanout_recipients_total', "Frames queued by fan-out")
+
+
+def encode_frame(message):
+    #envelope -> ready-to-send frame (length prefix included)
+    return codec.encode_frame(message)
+
+
+@profiling.span('fan_out')
+def fan_out(frame, recipients, kind=OTHER):
+    #queues the same frame to every recipient's outbound queue, returns the ones that failed
+    started = time.perf_counter()
+    failed = []
+    for client in recipients:
+        try:
+            if not client.send_frame(frame, kind):
+                failed.append(client)
+        except Exception:
+            failed.append(client)
+    FANOUT_TIME.observe_since(started)
+    FANOUT_RECIPIENTS.inc(len(recipients))
+    return failed
+
+
+def broadcast(message, recipients):
+    frame = encode_frame(message)
+    return fan_out(frame, recipients, message_kind(message.get('type')))
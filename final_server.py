@@ -1,11 +1,39 @@
 import socket
-import pickle
-from threading import Thread
+from threading import RLock, Thread
 from datetime import datetime
 import random
 import time
+from archive import DrawingArchive
+from chat_history import ChatHistory
+from codec import decode
+import compression
+from drawing_store import DrawingStore
+import fanout
+import handshake
+from fanout import encode_frame, fan_out
+import log
+import metrics
+import profiling
+from outbound import CHAT, DEFAULT_POLICY, DRAWING, OutboundQueue, message_kind
+from protocol import FrameBuffer
+from registry import Registry
+from tiles import TileError, apply_tiles
 
 BUFFER_SIZE = 65536
+OUTBOUND_POLICY = dict(DEFAULT_POLICY)  # slow consumer policy for every client queue
+DRAWING_MEMORY_BUDGET = 64 * 1024 * 1024
+DRAWING_SPILL_PATH = None  # e.g. 'drawings.seg' to keep evicted drawings on disk instead of dropping them
+ARCHIVE_DIR = 'archive'  # every exchanged drawing is appended here, None turns the archive off
+EXCHANGE_STAGES = ('snapshot', 'pair', 'encode', 'dispatch', 'archive', 'clear')
+METRICS_PORT = metrics.METRICS_PORT  # /metrics over http on 127.0.0.1, None turns it off
+METRICS_DUMP_PATH = None  # e.g. 'metrics.prom' to write the metrics to a file every few seconds
+
+CONNECTIONS = metrics.counter('drawer_connections_total', "Connections accepted")
+MESSAGES = metrics.counter('drawer_messages_total', "Messages received, by type", label='type')
+BYTES_IN = metrics.counter('drawer_bytes_received_total', "Bytes read from the clients")
+BYTES_OUT = metrics.counter('drawer_bytes_sent_total', "Bytes written to the clients")
+DECODE_FAILURES = metrics.counter('drawer_decode_failures_total', "Messages that could not be decoded or handled")
+EXCHANGE_TIME = metrics.histogram('drawer_exchange_ms', "Time of one exchange round")
 
 class Server(Thread):
     def __init__(self, address: str, port: int):
@@ -13,12 +41,16 @@ class Server(Thread):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind((address, port))
         self.sock.listen()
-        self.clients = []
-        self.drawings = {}  # stores the users drawings
+        self.registry = Registry()  # connected clients
+        self.drawings = DrawingStore(DRAWING_MEMORY_BUDGET, DRAWING_SPILL_PATH)  # stores the users drawings
+        self.archive = DrawingArchive(ARCHIVE_DIR) if ARCHIVE_DIR else None
+        self.last_exchange = {}  # stage timings of the last exchange (exchange_stats)
+        self.chat_history = ChatHistory()  # last chat messages, for the ones who connect later
+        self.add_metrics()
         self.start()
 
     def run(self):
-        print("Server started at 127.0.0.1:9003")
+        log.info('server_started', address="127.0.0.1:9003")
         
         # executing a timer for drawings exchange
         exchange_thread = Thread(target=self.exchange_loop, daemon=True)
@@ -27,80 +59,123 @@ class Server(Thread):
         while True:
             try:
                 client_conn, client_addr = self.sock.accept()
-                print(f"Client with address {client_addr} connected!")
-                client_handler = ClientHandler(client_conn, self)
-                self.clients.append(client_handler)
+                CONNECTIONS.inc()
+                log.info('client_connected', address=client_addr)
+                ClientHandler(client_conn, self)
                 
             except Exception as e:
-                print(f"Server error: {e}")
+                log.error('accept_failed', error=e)
+
+    def add_metrics(self):
+        #gauges are read from the live state when somebody asks for the metrics
+        metrics.gauge('drawer_clients', "Connected clients", lambda: len(self.registry))
+        metrics.gauge('drawer_outbound_frames', "Frames waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[0] for client in self.registry.all_clients()))
+        metrics.gauge('drawer_outbound_bytes', "Bytes waiting in the outbound queues",
+                      lambda: sum(client.outbound.depth()[1] for client in self.registry.all_clients()))
+        metrics.gauge('drawer_drawings_stored', "Drawings in the drawing store", lambda: self.drawings.stats()['drawings'])
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        if METRICS_DUMP_PATH:
+            metrics.dump_every(METRICS_DUMP_PATH)
+
+    def queue_depths(self):
+        #how much is waiting for every client: {name: (frames, bytes)}
+        return {client.name: client.outbound.depth() for client in self.registry.all_clients()}
 
     def exchange_loop(self):
         #loop for drawings exchange every 45 sec
         while True:
             time.sleep(45) 
-            if len(self.clients) >= 2: #we cannot start a game with only one player :))
-                print("Starting drawing exchange...")
+            if len(self.registry) >= 2: #we cannot start a game with only one player :))
                 self.exchange_drawings()
 
+    def exchange_stats(self):
+        #how long the stages of the last exchange took, in milliseconds
+        return dict(self.last_exchange)
+
+    @profiling.span('exchange')
     def exchange_drawings(self):
-        #changes the drawings between players
-        if len(self.clients) < 2:
+        #changes the drawings between players, in stages: snapshot the drawings, pair the
+        #players, encode every frame once, then hand the frames to the writer threads of the
+        #clients. nothing here waits for a socket, a slow pair doesn't hold up the others
+        clients = self.registry.all_clients()
+        if len(clients) < 2:
             return
-            
-        # a dictionary with all current drawings 
-        current_drawings = {}
-        for client in self.clients:
-            if hasattr(client, 'current_drawing') and client.current_drawing: #if the current drawing != None
-                current_drawings[client] = client.current_drawing
-                print(f"Collected drawing from {client.name}")
-        
-        if len(current_drawings) < 2:
-            print("Not enough drawings for exchange :( )")
+        timings = {}
+        started = stage = time.perf_counter()
+
+        def lap(name):
+            nonlocal stage
+            now = time.perf_counter()
+            timings[name] = (now - stage) * 1000
+            stage = now
+
+        #snapshot: (client, drawing id, png) of everybody who has a drawing right now
+        held = [(client, client.current_drawing) for client in clients]
+        snapshot = []
+        for client, drawing_id in held:
+            if drawing_id is not None: #if the current drawing != None
+                drawing = self.drawings.get(drawing_id)
+                if drawing is not None:
+                    snapshot.append((client, drawing_id, drawing))
+        lap('snapshot')
+
+        if len(snapshot) < 2:
+            log.info('exchange_skipped', drawings=len(snapshot))
             return
-            
+
         # Создаем пары случайным образом
-        players_with_drawings = list(current_drawings.keys())
-        random.shuffle(players_with_drawings)
-        
-        # Обмениваем рисунками между парами
-        for i in range(0, len(players_with_drawings), 2):
-            if i + 1 < len(players_with_drawings):
-                client1 = players_with_drawings[i]
-                client2 = players_with_drawings[i + 1]
-                
-                drawing1 = current_drawings[client1]
-                drawing2 = current_drawings[client2]
-                
-                print(f"Exchanging drawings between {client1.name} and {client2.name}")
-                
-                # Отправляем рисунок client2 клиенту client1
-                drawing_msg1 = {
-                    'type': 'drawing_exchange',
-                    'data': {
-                        'image_data': drawing2,  # Отправляем рисунок второго игрока первому
-                        'username': client2.name
-                    }
-                }
-                
-                # Отправляем рисунок client1 клиенту client2
-                drawing_msg2 = {
-                    'type': 'drawing_exchange', 
-                    'data': {
-                        'image_data': drawing1,  # Отправляем рисунок первого игрока второму
-                        'username': client1.name
-                    }
-                }
-                
-                try:
-                    client1.conn.send(pickle.dumps(drawing_msg1))
-                    client2.conn.send(pickle.dumps(drawing_msg2))
-                    print(f"Successfully exchanged drawings between {client1.name} and {client2.name}")
-                except Exception as e:
-                    print(f"Error sending drawings: {e}")
-        
+        random.shuffle(snapshot)
+        pairs = [(snapshot[i], snapshot[i + 1]) for i in range(0, len(snapshot) - 1, 2)]
+        lap('pair')
+
+        #every frame is encoded exactly once: player 1 gets the drawing of player 2 and visa versa
+        frames = [(encode_frame(self.drawing_exchange_msg(second)), encode_frame(self.drawing_exchange_msg(first)))
+                  for first, second in pairs]
+        lap('encode')
+
+        #only queued here, the writer thread of every client does the sending
+        exchanged = []
+        for (first, second), (frame1, frame2) in zip(pairs, frames):
+            client1, client2 = first[0], second[0]
+            if client1.send_frame(frame1, DRAWING) and client2.send_frame(frame2, DRAWING):
+                #the received drawing is the canvas they go on with, their next tiles build on it
+                client1.set_tile_base(second[1])
+                client2.set_tile_base(first[1])
+                exchanged.append((first, second))
+            else:
+                log.warning('exchange_send_failed', first=client1.name, second=client2.name)
+        lap('dispatch')
+
+        #disk writes last, the players already have their drawings
+        if self.archive is not None:
+            for (client1, _, drawing1), (client2, _, drawing2) in exchanged:
+                self.archive.append(None, client1.name, client2.name, drawing1)
+                self.archive.append(None, client2.name, client1.name, drawing2)
+        lap('archive')
+
         # Очищаем рисунки после обмена
-        for client in self.clients:
-            client.current_drawing = None
+        for client, drawing_id in held:
+            if drawing_id is not None:
+                client.clear_drawing(drawing_id)
+        lap('clear')
+
+        timings['total'] = (time.perf_counter() - started) * 1000
+        timings['pairs'] = len(exchanged)
+        self.last_exchange = timings
+        EXCHANGE_TIME.observe(timings['total'])
+        log.info('exchange_done', pairs=len(exchanged), total_ms=timings['total'],
+                 **{f"{name}_ms": timings[name] for name in EXCHANGE_STAGES})
+
+    def drawing_exchange_msg(self, sender):
+        return {
+            'type': 'drawing_exchange',
+            'data': {
+                'image_data': sender[2],
+                'username': sender[0].name
+            }
+        }
 
 class ClientHandler(Thread):
     def __init__(self, conn, server):
@@ -109,54 +184,165 @@ class ClientHandler(Thread):
         self.server = server
         self.name = "Unknown"
         self.current_drawing = None
+        self.tile_base = None  # drawing id the client's tiles are relative to (see set_tiles)
+        #the handler thread and the exchange both swap current_drawing / tile_base, every id
+        #that is swapped out is released exactly once by whoever swapped it
+        self.drawing_lock = RLock()
+        self.frames = FrameBuffer()
+        self.protocol_version = handshake.LEGACY_VERSION
+        self.compressor = None  # compression.FrameCompressor when the client agreed on compression
+        #outgoing frames wait here, only the writer thread touches the socket for sending
+        self.outbound = OutboundQueue(**OUTBOUND_POLICY)
+        #registered before the thread starts, so the cleanup in run always finds it
+        self.client_id = server.registry.add_client(self)
+        #started after the handshake, the answer to the hello has to be the first thing sent
+        self.writer = Thread(target=self.write_loop, daemon=True)
         self.start()
 
     def run(self):
         try:
-            # getting a username
-            name_data = self.conn.recv(1024)
-            self.name = name_data.decode('utf-8').strip()
-            print(f"Client registered as: {self.name}")
+            # getting a username (and what the client supports, see handshake.py)
+            self.name, self.protocol_version, method, early_frames = handshake.accept(self.conn, self.frames)
+            self.compressor = compression.frame_compressor(method)
+            self.writer.start()
+            log.info('client_registered', name=self.name, version=self.protocol_version, compression=method)
             
             # greetings
             welcome_msg = {'type': 'system', 'data': f"Hello, {self.name}!"}
-            self.conn.send(pickle.dumps(welcome_msg))
+            self.send(welcome_msg)
+            self.send_history(self.server.chat_history)
             
             # "meet-a-new-user" message
             join_msg = {'type': 'system', 'data': f"{self.name} joined the chat!"}
             self.broadcast(join_msg, include_self=True)
             
+            for frame in early_frames:
+                self.handle_frame(frame)
+
             # main loop
             while True:
                 data = self.conn.recv(BUFFER_SIZE)
                 if not data:
                     break
-                    
-                try:
-                    message = pickle.loads(data)
-                    self.process_message(message)
-                except Exception as e:
-                    print(f"Error decoding message: {e}")
+                BYTES_IN.inc(len(data))
+
+                #one recv can hold several messages or just a piece of one
+                for frame in self.frames.feed(data):
+                    self.handle_frame(frame)
                     
         except Exception as e:
-            print(f"Client {self.name} error: {e}")
+            log.warning('client_error', name=self.name, error=e)
         finally:
-            if self in self.server.clients:
-                self.server.clients.remove(self)
+            self.outbound.close()
+            if self.writer.ident is None:
+                self.conn.close()  # the handshake failed, no writer to close it
+            self.clear_drawing()
+            self.set_tile_base(None)
+            self.server.registry.remove_client(self.client_id)
             # informing others about person who leaves the chat
             leave_msg = {'type': 'system', 'data': f"{self.name} left the chat!"}
             self.broadcast(leave_msg, include_self=False)
-            print(f"Client {self.name} disconnected")
+            log.info('client_disconnected', name=self.name)
+
+    def handle_frame(self, frame):
+        try:
+            message = decode(frame)
+            MESSAGES.inc(label=metrics.message_type(message))
+            self.process_message(message)
+        except Exception as e:
+            DECODE_FAILURES.inc()
+            log.warning('bad_message', name=self.name, error=e)
+
+    def write_loop(self):
+        #drains the outbound queue, a slow socket only blocks this thread
+        while True:
+            batch = self.outbound.get_batch()
+            if batch is None:
+                break
+            try:
+                data = b''.join(batch)
+                self.conn.sendall(data)
+                BYTES_OUT.inc(len(data))
+            except Exception as e:
+                self.outbound.close(f"send failed: {e}")
+                break
+
+        if self.outbound.close_reason:
+            log.warning('client_dropped', name=self.name, reason=self.outbound.close_reason)
+        #wakes up the reader thread so that the usual cleanup runs
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_frame(self, frame, kind='other'):
+        #never blocks, frames are already encoded so broadcasts can share one buffer
+        if self.compressor is not None:
+            frame = self.compressor.frame(frame, skip=kind == DRAWING)
+        return self.outbound.put(frame, kind)
+
+    def send(self, message):
+        #sends one framed message to this client
+        return self.send_frame(encode_frame(message), message_kind(message.get('type')))
+
+    def send_history(self, history):
+        #the last messages in one frame, for clients that know chat_history
+        frame = history.frame()
+        if frame is not None and self.protocol_version >= handshake.HISTORY_VERSION:
+            self.send_frame(frame, CHAT)
+
+    def set_drawing(self, data):
+        #the store keeps the bytes (once per content), the handler only keeps the id
+        key = self.server.drawings.put(data)
+        with self.drawing_lock:
+            old_drawing, self.current_drawing = self.current_drawing, key
+        self.server.drawings.release(old_drawing)
+        return key
+
+    def clear_drawing(self, exchanged=None):
+        #exchanged = the id an exchange handed out, a newer upload stays for the next exchange
+        with self.drawing_lock:
+            old_drawing = self.current_drawing
+            if exchanged is not None and old_drawing != exchanged:
+                return
+            self.current_drawing = None
+        self.server.drawings.release(old_drawing)
+
+    def set_tile_base(self, key):
+        #the drawing the client's next tiles are relative to, kept in the store until it moves on
+        new_base = key if key is not None and self.server.drawings.retain(key) else None
+        with self.drawing_lock:
+            old_base, self.tile_base = self.tile_base, new_base
+        self.server.drawings.release(old_base)
+
+    def set_tiles(self, base, payload):
+        #changed tiles on top of a drawing we both know (tiles.py), the result is a normal png
+        try:
+            base_png = None
+            if base is not None:
+                if base != self.tile_base:
+                    raise TileError("Unknown tile base")
+                base_png = self.server.drawings.get(base)
+                if base_png is None:
+                    raise TileError("Tile base is gone")
+            drawing = apply_tiles(base_png, payload)
+        except TileError as e:
+            #the client starts over from a white canvas
+            log.warning('tiles_rejected', name=self.name, error=e)
+            self.send({'type': 'tiles_ack', 'data': {'given': None}})
+            return
+        with self.drawing_lock:
+            #an exchange can't clear the drawing before it became the tile base
+            key = self.set_drawing(drawing)
+            self.set_tile_base(key)
+        self.send({'type': 'tiles_ack', 'data': {'given': key}})
 
     def broadcast(self, message, include_self=False):
-        #sends messages to everyone
-        for client in self.server.clients:
-            if client != self or include_self:
-                try:
-                    client.conn.send(pickle.dumps(message))
-                except:
-                    pass
+        #sends messages to everyone, the message is encoded only once
+        recipients = [client for client in self.server.registry.all_clients() if client != self or include_self]
+        fanout.broadcast(message, recipients)
 
+    @profiling.message_span
     def process_message(self, message):
         msg_type = message.get('type')
         data = message.get('data')
@@ -171,14 +357,23 @@ class ClientHandler(Thread):
                     'timestamp': datetime.now().strftime('%H:%M:%S')
                 }
             }
-            self.broadcast(chat_msg, include_self=True)
+            #encoded once, the same frame goes to the history for the ones who come later
+            frame = encode_frame(chat_msg)
+            self.server.chat_history.add(frame)
+            fan_out(frame, self.server.registry.all_clients(), CHAT)
                         
         elif msg_type == 'drawing_ready':
             # saving a drawing for exchange
-            self.current_drawing = data
-            print(f"Received drawing from {self.name} for exchange")
+            self.set_drawing(data)
+            log.debug('drawing_received', name=self.name)
+
+        elif msg_type == 'drawing_tiles':
+            # only the tiles that changed, the server builds the png
+            self.set_tiles(data['base'], data['tiles'])
+            log.debug('tiles_received', name=self.name)
 
 if __name__ == '__main__':
+    profiling.install()
     server = Server("127.0.0.1", 9003)
     
     try:
@@ -186,4 +381,4 @@ if __name__ == '__main__':
             input("Press enter to stop the server\n")
             break
     except KeyboardInterrupt:
-        print("Server stopped!")
\ No newline at end of file
+        log.info('server_stopped')
\ No newline at end of file
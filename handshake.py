@@ -0,0 +1,111 @@
+import socket
+import compression
+from codec import CodecError, decode, encode_frame
+from protocol import HEADER, MAX_FRAME_SIZE, recv_frames
+
+#versioned handshake, the first thing on every connection
+#  client -> server: hello {'version', 'name', 'compression': methods the client supports}
+#  server -> client: hello {'version', 'compression': the method for this connection or None}
+#after that both sides may send compressed payloads (compression.py).
+#legacy clients just send their name as raw utf-8 and never get anything new. a hello frame
+#starts with the length prefix (first byte 0), a name never starts with a NUL byte
+
+#1: compression, 2: chat_history on connect / join (chat_history.py)
+PROTOCOL_VERSION = 2
+LEGACY_VERSION = 0
+HISTORY_VERSION = 2
+
+
+class HandshakeError(Exception):
+    pass
+
+
+def is_hello(first_byte):
+    return first_byte == b'\x00'
+
+
+def client_hello(name, methods=None):
+    #the frame a client opens the connection with
+    return encode_frame({'type': 'hello', 'data': {
+        'version': PROTOCOL_VERSION,
+        'name': name,
+        'compression': compression.METHODS if methods is None else methods,
+    }})
+
+
+def parse_hello(message):
+    if message.get('type') != 'hello' or not isinstance(message.get('data'), dict):
+        raise HandshakeError("Expected a hello")
+    return message['data']
+
+
+def negotiate(hello):
+    #server side: returns (version, compression method or None, reply frame)
+    version = hello.get('version')
+    if not isinstance(version, int) or version < 1:
+        raise HandshakeError("Bad protocol version")
+    version = min(version, PROTOCOL_VERSION)
+    offered = hello.get('compression')
+    if offered is None:
+        offered = []
+    #a string would match by substring ('zlib' in 'xzlibx'), a dict by its keys
+    if not isinstance(offered, list) or not all(isinstance(method, str) for method in offered):
+        raise HandshakeError("Bad compression list")
+    method = next((method for method in compression.METHODS if method in offered), None)
+    reply = encode_frame({'type': 'hello', 'data': {'version': version, 'compression': method}})
+    return version, method, reply
+
+
+def accept(conn, frames):
+    #threaded servers: reads the client's hello (or legacy name) from a blocking socket.
+    #returns (name, version, compression method, frames that came in right behind the hello)
+    first = conn.recv(1, socket.MSG_PEEK)
+    if not first:
+        raise HandshakeError("Closed before the handshake")
+    if not is_hello(first):
+        return conn.recv(1024).decode('utf-8').strip(), LEGACY_VERSION, None, []
+    received = recv_frames(conn, frames)
+    if not received:
+        raise HandshakeError("Closed during the handshake")
+    try:
+        hello = parse_hello(decode(received[0]))
+    except CodecError as e:
+        raise HandshakeError(f"Bad hello: {e}")
+    version, method, reply = negotiate(hello)
+    conn.sendall(reply)
+    return str(hello.get('name', '')).strip(), version, method, received[1:]
+
+
+async def accept_async(reader, writer):
+    #asyncio servers, same as accept. a client sends nothing else before it has the answer
+    data = await reader.read(1024)
+    if not data:
+        raise HandshakeError("Closed before the handshake")
+    if not is_hello(data[:1]):
+        return data.decode('utf-8').strip(), LEGACY_VERSION, None
+    if len(data) < HEADER.size:
+        data += await reader.readexactly(HEADER.size - len(data))
+    (length,) = HEADER.unpack_from(data)
+    missing = HEADER.size + length - len(data)
+    if length > MAX_FRAME_SIZE or missing < 0:
+        raise HandshakeError("Bad hello frame")
+    if missing:
+        data += await reader.readexactly(missing)
+    try:
+        hello = parse_hello(decode(data[HEADER.size:]))
+    except CodecError as e:
+        raise HandshakeError(f"Bad hello: {e}")
+    version, method, reply = negotiate(hello)
+    writer.write(reply)
+    return str(hello.get('name', '')).strip(), version, method
+
+
+def connect(sock, name, frames, methods=None):
+    #client side: sends the hello and waits for the answer,
+    #returns (compression method or None, messages that came in with the answer)
+    sock.sendall(client_hello(name, methods))
+    received = recv_frames(sock, frames)
+    if not received:
+        raise HandshakeError("The server closed the connection")
+    reply = parse_hello(decode(received[0]))
+    return reply.get('compression'), [decode(frame) for frame in received[1:]]
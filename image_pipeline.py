@@ -0,0 +1,134 @@
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from tiles import pack_changed, tile_hashes
+
+#image work on worker threads (cutting the canvas into tiles, decoding received pngs),
+#so the gui doesn't freeze for an exchange
+#QPixmap belongs to the gui thread, the workers only ever see QImage (safe in any thread).
+#results come back through queued signals, so the callbacks run on the gui thread again
+
+WORKERS = 2
+
+
+def rgb_pixels(image):
+    #QImage -> (rgb bytes, width, height, bytes per line), what tiles.py works on
+    image = image.convertToFormat(QtGui.QImage.Format_RGB888)
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    return bytes(bits), image.width(), image.height(), image.bytesPerLine()
+
+
+class ImageSignals(QObject):
+    done = pyqtSignal(int, object)  # job id, result of the job
+    failed = pyqtSignal(int, str)
+
+
+class DecodeJob(QRunnable):
+    def __init__(self, job_id, data, size, signals):
+        super().__init__()
+        self.job_id = job_id
+        self.data = data
+        self.size = size
+        self.signals = signals
+
+    def run(self):
+        try:
+            image = QtGui.QImage()
+            if not image.loadFromData(self.data, "PNG"):
+                raise ValueError("not a png")
+            if self.size is not None and image.size() != self.size:
+                image = image.scaled(self.size, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+            self.signals.done.emit(self.job_id, image)
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Error loading png: {e}")
+
+
+class TileJob(QRunnable):
+    def __init__(self, job_id, image, base_hashes, signals):
+        super().__init__()
+        self.job_id = job_id
+        self.image = image
+        self.base_hashes = base_hashes
+        self.signals = signals
+
+    def run(self):
+        try:
+            raw, width, height, stride = rgb_pixels(self.image)
+            self.signals.done.emit(self.job_id, pack_changed(raw, width, height, stride, self.base_hashes))
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Error cutting tiles: {e}")
+
+
+class HashJob(QRunnable):
+    def __init__(self, job_id, image, signals):
+        super().__init__()
+        self.job_id = job_id
+        self.image = image
+        self.signals = signals
+
+    def run(self):
+        try:
+            raw, width, height, stride = rgb_pixels(self.image)
+            self.signals.done.emit(self.job_id, tile_hashes(raw, width, height, stride))
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, f"Error hashing tiles: {e}")
+
+
+class ImagePipeline(QObject):
+    def __init__(self, workers=WORKERS):
+        super().__init__()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(workers)
+        self.signals = ImageSignals()
+        self.signals.done.connect(self.job_done)
+        self.signals.failed.connect(self.job_failed)
+        self.next_id = 0
+        self.callbacks = {}  # job id -> callback
+        self.latest = {}  # key -> newest job id, older jobs with the same key are dropped
+
+    def decode(self, data, callback, size=None, key=None):
+        #png bytes -> QImage (scaled to size), callback(image) on the gui thread
+        job_id = self.add_job(callback, key)
+        self.pool.start(DecodeJob(job_id, data, size, self.signals))
+        return job_id
+
+    def encode_tiles(self, image, base_hashes, callback, key=None):
+        #QImage -> tiles changed since the base, callback((payload, hashes, changed)) on the gui thread
+        job_id = self.add_job(callback, key)
+        self.pool.start(TileJob(job_id, image, base_hashes, self.signals))
+        return job_id
+
+    def hash_tiles(self, image, callback, key=None):
+        #QImage -> tile hashes, callback(hashes) on the gui thread
+        job_id = self.add_job(callback, key)
+        self.pool.start(HashJob(job_id, image, self.signals))
+        return job_id
+
+    def add_job(self, callback, key):
+        self.next_id += 1
+        self.callbacks[self.next_id] = (callback, key)
+        if key is not None:
+            self.latest[key] = self.next_id
+        return self.next_id
+
+    def finish_job(self, job_id):
+        #returns the callback, or None if a newer job with the same key came in meanwhile
+        callback, key = self.callbacks.pop(job_id, (None, None))
+        if key is not None:
+            if self.latest.get(key) != job_id:
+                return None
+            del self.latest[key]
+        return callback
+
+    def job_done(self, job_id, result):
+        callback = self.finish_job(job_id)
+        if callback:
+            callback(result)
+
+    def job_failed(self, job_id, error):
+        self.finish_job(job_id)
+        print(error)
+
+    def wait(self):
+        #blocks until all jobs are done (used when the window closes)
+        self.pool.waitForDone()
@@ -0,0 +1,230 @@
+import argparse
+import asyncio
+import os
+import random
+import struct
+import time
+import zlib
+from codec import decode, encode_frame
+from protocol import read_frame
+
+#headless load generator for final_server.py / SemProj-server.py / async_server.py
+#simulates many players from one process: name handshake, chat, join_room and drawing_ready
+#
+#  python loadgen.py --players 2000 --mode rooms --duration 120 --server-pid 12345
+#
+#(raise the open files limit first for big runs: ulimit -n 20000)
+
+CHAT_MARK = 'lg'
+
+
+def fake_png(noise, salt=b''):
+    #a real png file (signature + IHDR + one IDAT of incompressible noise), about 57 bytes more than
+    #the noise. the salt replaces the first noise bytes: the server keeps one copy per content
+    #(drawing_store.py), so every upload of every player has to be a different drawing
+    def chunk(kind, body):
+        return struct.pack('!I', len(body)) + kind + body + struct.pack('!I', zlib.crc32(kind + body))
+    header = struct.pack('!IIBBBBB', 600, 600, 8, 2, 0, 0, 0)
+    noise = zlib.compress(salt + noise[len(salt):], 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', noise) + chunk(b'IEND', b'')
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+
+    def at(p):
+        return values[min(int(len(values) * p), len(values) - 1)] * 1000
+    return f"p50 {at(0.5):.1f} ms  p90 {at(0.9):.1f} ms  p99 {at(0.99):.1f} ms  max {values[-1] * 1000:.1f} ms"
+
+
+class ProcessSampler:
+    #reads rss and cpu time of the server from /proc (linux only)
+    def __init__(self, pid):
+        self.pid = pid
+        self.max_rss = 0
+        self.start_cpu = None
+        self.start_time = None
+        self.cpu_percent = 0.0
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def rss_kb(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return 0
+
+    async def run(self):
+        self.start_cpu = self.cpu_seconds()
+        self.start_time = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self.max_rss = max(self.max_rss, self.rss_kb())
+            elapsed = time.monotonic() - self.start_time
+            self.cpu_percent = (self.cpu_seconds() - self.start_cpu) / elapsed * 100
+
+
+class Stats:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.connect_time = 0.0
+        self.chat_sent = 0
+        self.chat_received = 0
+        self.chat_latencies = []
+        self.drawings_sent = 0
+        self.exchanges = []  # receive times of drawing_exchange messages
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def exchange_waves(self, gap=5.0):
+        #exchanges that are less than `gap` apart belong to one round, returns how long each round took
+        waves = []
+        start = last = None
+        for t in sorted(self.exchanges):
+            if last is None or t - last > gap:
+                if start is not None:
+                    waves.append(last - start)
+                start = t
+            last = t
+        if start is not None:
+            waves.append(last - start)
+        return waves
+
+
+class Player:
+    def __init__(self, number, args, stats, noise):
+        self.number = number
+        self.name = f"bot{number}"
+        self.args = args
+        self.stats = stats
+        self.noise = noise  # shared by all players, salted per upload
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.writer.write(self.name.encode('utf-8'))
+        #the name has to arrive alone, so wait for the welcome before sending anything else
+        await read_frame(self.reader)
+        if self.args.mode == 'rooms':
+            self.send({'type': 'join_room', 'data': str(self.number // 2)})
+
+    def send(self, message):
+        self.writer.write(encode_frame(message))
+
+    async def receive(self):
+        while True:
+            frame = await read_frame(self.reader)
+            if frame is None:
+                return
+            now = time.time()
+            self.stats.frames_received += 1
+            self.stats.bytes_received += len(frame) + 4
+            message = decode(frame)
+            msg_type = message['type']
+            if msg_type == 'chat':
+                self.stats.chat_received += 1
+                parts = message['data']['text'].split(':')
+                if len(parts) == 3 and parts[0] == CHAT_MARK:
+                    self.stats.chat_latencies.append(now - float(parts[2]))
+            elif msg_type in ('drawing_exchange', 'stroke_exchange'):
+                self.stats.exchanges.append(now)
+
+    async def chat(self):
+        if self.args.chat_interval <= 0:
+            return
+        await asyncio.sleep(random.uniform(0, self.args.chat_interval))
+        while True:
+            self.send({'type': 'chat', 'data': f"{CHAT_MARK}:{self.name}:{time.time()}"})
+            self.stats.chat_sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(self.args.chat_interval)
+
+    async def draw(self):
+        await asyncio.sleep(random.uniform(0, self.args.drawing_interval))
+        while True:
+            png = fake_png(self.noise, f"{self.number}:{self.stats.drawings_sent}:".encode())
+            self.send({'type': 'drawing_ready', 'data': png})
+            self.stats.drawings_sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(self.args.drawing_interval)
+
+    async def play(self):
+        await asyncio.gather(self.receive(), self.chat(), self.draw())
+
+
+async def main(args):
+    stats = Stats()
+    noise = os.urandom(max(args.png_size - 57, 0))
+    players = [Player(number, args, stats, noise) for number in range(args.players)]
+
+    sampler = ProcessSampler(args.server_pid) if args.server_pid else None
+    sampler_task = asyncio.create_task(sampler.run()) if sampler else None
+
+    #connect in batches so that the accept backlog is not flooded
+    start = time.monotonic()
+    connected = []
+    for first in range(0, len(players), args.connect_batch):
+        batch = players[first:first + args.connect_batch]
+        results = await asyncio.gather(*(p.connect() for p in batch), return_exceptions=True)
+        for player, result in zip(batch, results):
+            if isinstance(result, Exception):
+                stats.failed += 1
+            else:
+                connected.append(player)
+    stats.connect_time = time.monotonic() - start
+    stats.connected = len(connected)
+    print(f"connected {stats.connected} players ({stats.failed} failed) in {stats.connect_time:.2f} s")
+
+    tasks = [asyncio.create_task(p.play()) for p in connected]
+    await asyncio.sleep(args.duration)
+    for task in tasks:
+        task.cancel()
+    if sampler_task:
+        sampler_task.cancel()
+
+    report(stats, sampler, args)
+
+
+def report(stats, sampler, args):
+    rate = stats.connected / stats.connect_time if stats.connect_time else 0
+    print(f"connect rate:      {rate:.0f} connections/s")
+    print(f"chat sent/recv:    {stats.chat_sent} / {stats.chat_received}")
+    print(f"chat fan-out:      {percentiles(stats.chat_latencies)}")
+    print(f"drawings sent:     {stats.drawings_sent}")
+    print(f"exchanges recv:    {len(stats.exchanges)}")
+    waves = stats.exchange_waves()
+    if waves:
+        print(f"exchange rounds:   {len(waves)}, slowest took {max(waves) * 1000:.1f} ms from first to last player")
+    print(f"received:          {stats.frames_received} frames, {stats.bytes_received / 1e6:.1f} MB"
+          f" ({stats.bytes_received / 1e6 / args.duration:.2f} MB/s)")
+    if sampler:
+        print(f"server rss:        {sampler.max_rss / 1024:.1f} MB max")
+        print(f"server cpu:        {sampler.cpu_percent:.0f} %")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load generator for the drawing game servers")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9003)
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--mode', choices=('final', 'rooms'), default='final',
+                        help="final = global chat and exchange (final_server.py), rooms = pairs join /room")
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds of play after everybody connected")
+    parser.add_argument('--chat-interval', type=float, default=5.0, help="seconds between chats per player, 0 = off")
+    parser.add_argument('--drawing-interval', type=float, default=45.0)
+    parser.add_argument('--png-size', type=int, default=60 * 1024)
+    parser.add_argument('--connect-batch', type=int, default=200)
+    parser.add_argument('--server-pid', type=int, help="pid of the server, to sample its rss and cpu")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
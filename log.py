@@ -0,0 +1,98 @@
+import os
+import re
+import time
+from threading import Lock
+
+#leveled, rate limited logging for the servers, one line per event with key=value fields:
+#  12:00:01.123 INFO client_joined name=bob room=r1
+#a call below the level returns right away (the fields are only formatted for lines that are
+#written), and every event writes at most RATE_LIMIT lines per second. the lines over the limit
+#are counted and show up as suppressed=N on the next line of the same event
+#the level comes from the environment: DRAWER_LOG_LEVEL=debug|info|warning|error|off
+
+DEBUG, INFO, WARNING, ERROR, OFF = 10, 20, 30, 40, 100
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+RATE_LIMIT = 20  # lines per second for one event
+#a value with any of these is quoted, control characters are escaped so a name or chat text
+#can't end the line and forge the next one
+NEEDS_QUOTES = re.compile(r'[ ="\\\x00-\x1f\x7f-\x9f\u2028\u2029]')
+ESCAPED = re.compile(r'["\\\x00-\x1f\x7f-\x9f\u2028\u2029]')
+ESCAPES = {'"': r'\"', '\\': r'\\', '\n': r'\n', '\r': r'\r', '\t': r'\t'}
+
+level = LEVELS.get(os.environ.get('DRAWER_LOG_LEVEL', 'info').lower(), INFO)
+_lock = Lock()
+_windows = {}  # event -> [second, lines written in it, lines suppressed]
+
+
+def set_level(name):
+    global level
+    level = LEVELS[name.lower()]
+
+
+def enabled(at):
+    #for callers that have to do work just to build the fields
+    return at >= level
+
+
+def debug(event, **fields):
+    if DEBUG >= level:
+        _write(DEBUG, event, fields)
+
+
+def info(event, **fields):
+    if INFO >= level:
+        _write(INFO, event, fields)
+
+
+def warning(event, **fields):
+    if WARNING >= level:
+        _write(WARNING, event, fields)
+
+
+def error(event, **fields):
+    if ERROR >= level:
+        _write(ERROR, event, fields)
+
+
+def _write(at, event, fields):
+    now = time.time()
+    second = int(now)
+    with _lock:
+        window = _windows.get(event)
+        if window is None:
+            window = _windows[event] = [second, 0, 0]
+        elif window[0] != second:
+            window[0] = second
+            window[1] = 0
+        if window[1] >= RATE_LIMIT:
+            window[2] += 1
+            return
+        window[1] += 1
+        suppressed = window[2]
+        window[2] = 0
+
+    parts = [time.strftime('%H:%M:%S', time.localtime(now)) + f".{int(now % 1 * 1000):03d}",
+             LEVEL_NAMES[at], event]
+    parts.extend(f"{key}={_format(value)}" for key, value in fields.items())
+    if suppressed:
+        parts.append(f"suppressed={suppressed}")
+    print(' '.join(parts))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    text = str(value)
+    if not text:
+        return '""'
+    if NEEDS_QUOTES.search(text):
+        return '"' + ESCAPED.sub(_escape, text) + '"'
+    return text
+
+
+def _escape(match):
+    c = match.group()
+    if c in ESCAPES:
+        return ESCAPES[c]
+    return f"\\x{ord(c):02x}" if ord(c) < 0x100 else f"\\u{ord(c):04x}"
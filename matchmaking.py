@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+import metrics
+
+#matchmaking: players ask for a game (/play [size]) and wait in a queue per room size,
+#as soon as there are enough of them they get a fresh room together.
+#queues are OrderedDicts: joining, leaving (disconnect, /room) and taking the oldest are all O(1)
+
+MIN_ROOM_SIZE = 2
+MAX_ROOM_SIZE = 8
+WAIT_SAMPLES = 1024  # how many of the last waiting times we keep for the percentiles
+WAIT_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000)  # milliseconds
+
+TIME_TO_GAME = metrics.histogram('drawer_time_to_game_ms', "Time from /play to a match", WAIT_BUCKETS)
+
+
+class Matchmaker:
+    def __init__(self):
+        self.lock = Lock()
+        self.queues = {}  # room size -> OrderedDict(client id -> (client, time queued)), oldest first
+        self.waiting = {}  # client id -> room size it waits for
+        self.taken = {}  # client id -> time queued, for players of a match that hasn't started yet
+        self.matched = 0
+        self.wait_times = deque(maxlen=WAIT_SAMPLES)  # time to game of the last matched players
+
+    def enqueue(self, client_id, client, size):
+        #returns the players of the new game (oldest first) or None if the queue is not full yet
+        if not MIN_ROOM_SIZE <= size <= MAX_ROOM_SIZE:
+            raise ValueError(f"room size must be {MIN_ROOM_SIZE}-{MAX_ROOM_SIZE}")
+        with self.lock:
+            self._remove(client_id)
+            queue = self.queues.setdefault(size, OrderedDict())
+            queue[client_id] = (client, time.monotonic())
+            self.waiting[client_id] = size
+            return self._take(queue, size)
+
+    def requeue(self, players, size):
+        #the players of a match that fell apart (somebody left before the room was full) go back
+        #to the front of their queue, in the same order and with the time they first asked for a
+        #game. returns a new game like enqueue does
+        with self.lock:
+            queue = self.queues.setdefault(size, OrderedDict())
+            now = time.monotonic()
+            for player in reversed(players):
+                self._remove(player.client_id)
+                queue[player.client_id] = (player, self.taken.pop(player.client_id, now))
+                queue.move_to_end(player.client_id, last=False)
+                self.waiting[player.client_id] = size
+            return self._take(queue, size)
+
+    def started(self, players):
+        #the match is on (everybody is in the room): only now their wait counts as a time to game
+        with self.lock:
+            now = time.monotonic()
+            for player in players:
+                queued = self.taken.pop(player.client_id, None)
+                if queued is not None:
+                    self.wait_times.append(now - queued)
+                    TIME_TO_GAME.observe((now - queued) * 1000)
+            self.matched += len(players)
+
+    def _take(self, queue, size):
+        #the oldest size players if there are enough of them, they wait in taken until the match
+        #starts (started) or falls apart (requeue)
+        if len(queue) < size:
+            return None
+        players = []
+        for _ in range(size):
+            player_id, (player, queued) = queue.popitem(last=False)
+            del self.waiting[player_id]
+            self.taken[player_id] = queued
+            players.append(player)
+        return players
+
+    def remove(self, client_id):
+        #the player does not wait anymore (disconnected or joined a room by hand)
+        with self.lock:
+            return self._remove(client_id)
+
+    def _remove(self, client_id):
+        self.taken.pop(client_id, None)
+        size = self.waiting.pop(client_id, None)
+        if size is None:
+            return False
+        del self.queues[size][client_id]
+        return True
+
+    def stats(self):
+        #players waiting per room size and time to game in milliseconds
+        with self.lock:
+            waits = sorted(self.wait_times)
+            waiting = {size: len(queue) for size, queue in self.queues.items() if queue}
+
+        def at(p):
+            return waits[min(int(len(waits) * p), len(waits) - 1)] * 1000 if waits else 0.0
+        return {
+            'waiting': waiting,
+            'matched': self.matched,
+            'time_to_game_p50_ms': at(0.5),
+            'time_to_game_p99_ms': at(0.99),
+            'time_to_game_max_ms': waits[-1] * 1000 if waits else 0.0,
+        }
@@ -0,0 +1,211 @@
+import bisect
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import codec
+import log
+
+#counters, gauges and histograms of the servers, exported in the prometheus text format
+#over http (curl 127.0.0.1:9100/metrics) or written to a file every few seconds.
+#the metrics are created when a module is imported, updating one is a lock and an add.
+#gauges can also take a function, it is only called when somebody reads the metrics
+
+METRICS_PORT = 9100
+DUMP_INTERVAL = 10.0  # seconds
+TIME_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)  # milliseconds
+
+_metrics = {}  # name -> metric, in the order they were created
+_lock = Lock()
+
+
+def _labels(label_name, label):
+    if label_name is None or label is None:
+        return ''
+    return f'{{{label_name}="{label}"}}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label  # name of the label, e.g. 'type' for messages per type
+        self.lock = Lock()
+        self.values = {}  # label value (None without a label) -> count
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def value(self, label=None):
+        with self.lock:
+            return self.values.get(label, 0)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [(self.name + _labels(self.label, label), value) for label, value in values]
+
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, description, function=None, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.function = function  # returns the value (or {label: value}) when the metrics are read
+        self.lock = Lock()
+        self.values = {}
+
+    def set(self, value, label=None):
+        with self.lock:
+            self.values[label] = value
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def dec(self, amount=1, label=None):
+        self.inc(-amount, label)
+
+    def samples(self):
+        if self.function is not None:
+            value = self.function()
+            values = value.items() if isinstance(value, dict) else [(None, value)]
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        return [(self.name + _labels(self.label, label), value) for label, value in values]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=TIME_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_since(self, started):
+        #started = time.perf_counter() from before the work, observed in milliseconds
+        self.observe((time.perf_counter() - started) * 1000)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            samples.append((f'{self.name}_bucket{{le="{bound}"}}', cumulative))
+        samples.append((self.name + '_sum', total))
+        samples.append((self.name + '_count', count))
+        return samples
+
+
+def _get_or_create(cls, name, *args, **kwargs):
+    #the same name gives the same metric, several server modules can share one
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name, description, label=None):
+    return _get_or_create(Counter, name, description, label)
+
+
+def gauge(name, description, function=None, label=None):
+    metric = _get_or_create(Gauge, name, description, None, label)
+    if function is not None:
+        metric.function = function  # the newest server owns it
+    return metric
+
+
+def histogram(name, description, buckets=TIME_BUCKETS):
+    return _get_or_create(Histogram, name, description, buckets)
+
+
+def message_type(message):
+    #label of a received message, custom type names all count as 'other' so the labels stay few
+    msg_type = message.get('type')
+    return msg_type if msg_type in codec.TYPE_TAGS else 'other'
+
+
+def render():
+    #all metrics in the prometheus text format
+    with _lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            log.warning('metric_failed', name=metric.name, error=e)
+            continue
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name} {value}" for name, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line for every scrape
+
+
+def serve(port=METRICS_PORT, host='127.0.0.1'):
+    #/metrics on a thread of its own, returns the http server or None if the port is taken
+    try:
+        httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        log.warning('metrics_not_served', port=port, error=e)
+        return None
+    httpd.daemon_threads = True
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    log.info('metrics_served', url=f"http://{host}:{port}/metrics")
+    return httpd
+
+
+def dump_every(path, interval=DUMP_INTERVAL):
+    #for when there is no http: the metrics are written to path every interval seconds
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(render())
+                os.replace(path + '.tmp', path)  # a reader never sees half a file
+            except OSError as e:
+                log.warning('metrics_dump_failed', path=path, error=e)
+
+    thread = Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
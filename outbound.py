@@ -0,0 +1,153 @@
+import asyncio
+from collections import deque
+from threading import Condition
+
+#per-connection outbound queues
+#every connection gets its own bounded queue and its own writer, so one slow client
+#only fills up its own queue instead of blocking the thread that broadcasts
+#
+#slow consumer policies (all configurable per queue):
+#  drop_chat          - above high_water the oldest queued chat messages are dropped
+#  coalesce_drawings  - a newer drawing replaces a drawing that is still waiting
+#  disconnect_at      - above this many queued bytes the client is disconnected
+
+CHAT = 'chat'
+DRAWING = 'drawing'
+OTHER = 'other'
+
+HIGH_WATER = 1024 * 1024  # 1 MB
+DISCONNECT_AT = 8 * 1024 * 1024  # 8 MB
+
+DEFAULT_POLICY = {
+    'high_water': HIGH_WATER,
+    'disconnect_at': DISCONNECT_AT,
+    'drop_chat': True,
+    'coalesce_drawings': True,
+}
+
+
+def message_kind(msg_type):
+    if msg_type == 'chat':
+        return CHAT
+    if msg_type == 'drawing_exchange':
+        return DRAWING
+    return OTHER
+
+
+class OutboundBuffer:
+    #the policy part, without any locking (see OutboundQueue / AsyncOutboundQueue)
+    def __init__(self, high_water=HIGH_WATER, disconnect_at=DISCONNECT_AT,
+                 drop_chat=True, coalesce_drawings=True):
+        self.high_water = high_water
+        self.disconnect_at = disconnect_at
+        self.drop_chat = drop_chat
+        self.coalesce_drawings = coalesce_drawings
+        self.items = deque()  # [kind, frame]
+        self.bytes = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+        self.close_reason = None
+
+    def depth(self):
+        #(frames, bytes) waiting to be written
+        return len(self.items), self.bytes
+
+    def _push(self, frame, kind):
+        if self.closed:
+            return False
+
+        if kind == DRAWING and self.coalesce_drawings:
+            for entry in self.items:
+                if entry[0] == DRAWING:
+                    #the old drawing was not sent yet, nobody needs it anymore
+                    self.items.remove(entry)
+                    self.bytes -= len(entry[1])
+                    self.coalesced += 1
+                    break
+
+        self.items.append([kind, frame])
+        self.bytes += len(frame)
+
+        if self.bytes > self.high_water and self.drop_chat:
+            self._drop_oldest_chat()
+        if self.bytes > self.disconnect_at:
+            self._close(f"outbound queue over {self.disconnect_at} bytes")
+            return False
+        return True
+
+    def _drop_oldest_chat(self):
+        kept = deque()
+        for entry in self.items:
+            if self.bytes > self.high_water and entry[0] == CHAT:
+                self.bytes -= len(entry[1])
+                self.dropped += 1
+            else:
+                kept.append(entry)
+        self.items = kept
+
+    def _pop_all(self):
+        batch = [entry[1] for entry in self.items]
+        self.items.clear()
+        self.bytes = 0
+        return batch
+
+    def _close(self, reason=None):
+        if not self.closed:
+            self.closed = True
+            self.close_reason = reason
+            self.items.clear()
+            self.bytes = 0
+
+
+class OutboundQueue(OutboundBuffer):
+    #thread-safe version, drained by one writer thread per connection
+    def __init__(self, **policy):
+        super().__init__(**policy)
+        self.cond = Condition()
+
+    def put(self, frame, kind=OTHER):
+        #never blocks, returns False if the connection is closed (or just got closed)
+        with self.cond:
+            ok = self._push(frame, kind)
+            self.cond.notify()
+            return ok
+
+    def get_batch(self):
+        #blocks until something is queued, returns every waiting frame at once
+        #returns None when the queue was closed
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            return self._pop_all()
+
+    def close(self, reason=None):
+        with self.cond:
+            self._close(reason)
+            self.cond.notify()
+
+
+class AsyncOutboundQueue(OutboundBuffer):
+    #asyncio version, drained by one writer task per connection (same loop, no locks)
+    def __init__(self, **policy):
+        super().__init__(**policy)
+        self.ready = asyncio.Event()
+
+    def put(self, frame, kind=OTHER):
+        ok = self._push(frame, kind)
+        self.ready.set()
+        return ok
+
+    async def get_batch(self):
+        while not self.items and not self.closed:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.closed:
+            return None
+        return self._pop_all()
+
+    def close(self, reason=None):
+        self._close(reason)
+        self.ready.set()
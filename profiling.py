@@ -0,0 +1,163 @@
+import atexit
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+import log
+import metrics
+
+#profiling mode for the servers, for when latency spikes and we don't know where the time goes
+#  DRAWER_PROFILE=profile python SemProj-server.py     (or async_server.py --profile profile)
+#  kill -USR2 <pid>                                     turns it on / off while the server runs
+#
+#a sampler thread looks at the stack of every thread (handler threads or the event loop) every
+#few ms. on stop the samples go to profile.folded and the time spent per message type (and in
+#fan-out / exchanges) to profile.spans.folded, in microseconds. both are folded stacks:
+#  flamegraph.pl profile.folded > profile.svg   (or drop the file on speedscope.app)
+#the samples are wall clock, threads waiting in recv show up too.
+#turned off, a traced function costs one extra call and one global check
+
+PROFILE_PATH = os.environ.get('DRAWER_PROFILE')  # file prefix, None = off at startup
+SAMPLE_INTERVAL = float(os.environ.get('DRAWER_PROFILE_INTERVAL', '0.005'))  # seconds
+TOGGLE_SIGNAL = getattr(signal, 'SIGUSR2', None)
+THREAD_NAMES_EVERY = 1.0  # seconds between refreshing the thread -> kind map (new threads refresh it too)
+
+active = False
+_lock = threading.Lock()
+_stacks = Counter()  # folded stack -> samples
+_spans = {}  # folded span name -> [count, total seconds, max seconds]
+_sampler = None
+_path = None
+
+
+class Sampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(daemon=True, name='profiler')
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.kinds = {}  # thread id -> kind of thread (class name, so all handler threads fold together)
+        self.kinds_at = 0
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            now = time.monotonic()
+            if now - self.kinds_at > THREAD_NAMES_EVERY or not frames.keys() <= self.kinds.keys():
+                self.kinds = {thread.ident: type(thread).__name__ for thread in threading.enumerate()}
+                self.kinds_at = now
+            samples = []
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(self.kinds.get(ident, 'Thread'))
+                samples.append(';'.join(reversed(stack)))
+            with _lock:
+                _stacks.update(samples)
+
+
+def _add_span(name, seconds):
+    with _lock:
+        span = _spans.get(name)
+        if span is None:
+            span = _spans[name] = [0, 0.0, 0.0]
+        span[0] += 1
+        span[1] += seconds
+        span[2] = max(span[2], seconds)
+
+
+def span(name):
+    #decorator: the time spent in the function is added to the span name (when profiling)
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not active:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _add_span(name, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def message_span(function):
+    #decorator for process_message(self, message): one span per message type
+    @functools.wraps(function)
+    def wrapper(self, message):
+        if not active:
+            return function(self, message)
+        started = time.perf_counter()
+        try:
+            return function(self, message)
+        finally:
+            _add_span('message;' + metrics.message_type(message), time.perf_counter() - started)
+    return wrapper
+
+
+def start(path='profile', interval=SAMPLE_INTERVAL):
+    global active, _sampler, _path
+    with _lock:
+        if active:
+            return
+        _stacks.clear()
+        _spans.clear()
+        _path = path
+        _sampler = Sampler(interval)
+        active = True
+    _sampler.start()
+    log.info('profiling_started', path=path, interval_ms=interval * 1000)
+
+
+def stop():
+    #stops sampling and writes the folded files, returns their paths
+    global active, _sampler
+    with _lock:
+        if not active:
+            return None
+        active = False
+        sampler, _sampler = _sampler, None
+    sampler.stopped.set()
+    sampler.join()
+    with _lock:
+        stacks = sorted(_stacks.items())
+        spans = sorted(_spans.items())
+    samples_path, spans_path = _path + '.folded', _path + '.spans.folded'
+    with open(samples_path, 'w') as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in stacks)
+    with open(spans_path, 'w') as f:
+        f.writelines(f"{name} {int(total * 1e6)}\n" for name, (_, total, _) in spans)
+    log.info('profiling_stopped', samples=sum(count for _, count in stacks), path=samples_path)
+    for name, (count, total, longest) in spans:
+        log.info('profiling_span', span=name, count=count, total_ms=total * 1000,
+                 mean_ms=total * 1000 / count, max_ms=longest * 1000)
+    return samples_path, spans_path
+
+
+def toggle(path='profile'):
+    if active:
+        stop()
+    else:
+        start(path)
+
+
+def install(path=PROFILE_PATH, suffix=''):
+    #called once from the main thread of a server: starts profiling if a path is given,
+    #lets the toggle signal turn it on / off and writes the files when the process exits.
+    #suffix keeps the files of several processes apart
+    prefix = (path or 'profile') + suffix
+    if path:
+        start(prefix)
+    if TOGGLE_SIGNAL is not None:
+        #the files are written on another thread, never inside the signal handler
+        signal.signal(TOGGLE_SIGNAL, lambda signum, frame: threading.Thread(target=toggle, args=(prefix,)).start())
+    atexit.register(stop)
@@ -0,0 +1,77 @@
+import asyncio
+import struct
+
+#shared framing layer for the drawing game (server and client)
+#every message on the wire is a 4-byte big-endian length followed by the payload,
+#so big drawings can span many recv() calls and many small messages can share one
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16 MB is way more than a 600x600 png
+RECV_SIZE = 65536
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_frame(payload):
+    #length prefix + payload, ready for sendall()
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_frame(sock, payload):
+    #sendall keeps writing until the whole frame is out (send() may write only a part of it)
+    sock.sendall(pack_frame(payload))
+
+
+class FrameBuffer:
+    #reassembly buffer: feed it whatever recv() returned and get back the complete frames
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        offset = 0
+        total = len(self.buffer)
+
+        while total - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame too large: {length} bytes")
+
+            end = offset + HEADER.size + length
+            if end > total:
+                break  # the rest of this frame is still on its way
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+
+        #drop everything we already parsed, keep the incomplete tail
+        del self.buffer[:offset]
+        return frames
+
+
+def recv_frames(sock, frame_buffer, size=RECV_SIZE):
+    #blocks until at least one whole frame arrived
+    #returns an empty list when the other side closed the connection
+    while True:
+        data = sock.recv(size)
+        if not data:
+            return []
+        frames = frame_buffer.feed(data)
+        if frames:
+            return frames
+
+
+async def read_frame(reader, max_frame_size=MAX_FRAME_SIZE):
+    #asyncio version for StreamReader, the reader does the buffering for us
+    #returns None when the other side closed the connection
+    try:
+        header = await reader.readexactly(HEADER.size)
+        (length,) = HEADER.unpack(header)
+        if length > max_frame_size:
+            raise ProtocolError(f"Frame too large: {length} bytes")
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
@@ -0,0 +1,95 @@
+import itertools
+from threading import RLock
+
+#who is connected and who is in which room, shared by the accept thread and all handler threads.
+#everything is a dict keyed by the connection id, so adding and removing is O(1),
+#and the rooms nobody is in anymore are collected on the way instead of scanning all rooms.
+#readers get tuples (snapshots), a broadcast never iterates over something another thread changes
+
+
+class Registry:
+    def __init__(self):
+        self.lock = RLock()
+        self.ids = itertools.count(1)
+        self.clients = {}  # connection id -> client
+        self.rooms = {}  # room id -> room
+        self.members = {}  # room id -> {connection id: client}
+        self.client_rooms = {}  # connection id -> room id
+        self.empty_rooms = set()  # room ids without members, removed by pop_empty_rooms
+        self.snapshot = ()  # all clients, rebuilt on the next read after a change
+        self.snapshot_dirty = False
+
+    def __len__(self):
+        return len(self.clients)
+
+    def add_client(self, client):
+        #returns the connection id of the new client
+        with self.lock:
+            client_id = next(self.ids)
+            self.clients[client_id] = client
+            self.snapshot_dirty = True
+            return client_id
+
+    def remove_client(self, client_id):
+        #forgets the client, returns the room it was still in (or None)
+        with self.lock:
+            if self.clients.pop(client_id, None) is None:
+                return None
+            self.snapshot_dirty = True
+            return self.leave_room(client_id)
+
+    def all_clients(self):
+        with self.lock:
+            if self.snapshot_dirty:
+                self.snapshot = tuple(self.clients.values())
+                self.snapshot_dirty = False
+            return self.snapshot
+
+    def room(self, room_id):
+        return self.rooms.get(room_id)
+
+    def get_or_create_room(self, room_id, factory):
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = factory(room_id)
+                self.members[room_id] = {}
+                self.empty_rooms.add(room_id)
+            return room
+
+    def join_room(self, client_id, room_id, factory, capacity):
+        #returns the room or None if it is full, the room gets the new member list
+        with self.lock:
+            room = self.get_or_create_room(room_id, factory)
+            members = self.members[room_id]
+            if len(members) >= capacity or client_id not in self.clients:
+                return None
+            members[client_id] = self.clients[client_id]
+            self.client_rooms[client_id] = room_id
+            self.empty_rooms.discard(room_id)
+            room.set_clients(tuple(members.values()))
+            return room
+
+    def leave_room(self, client_id):
+        #returns the room the client left (or None)
+        with self.lock:
+            room_id = self.client_rooms.pop(client_id, None)
+            if room_id is None:
+                return None
+            members = self.members[room_id]
+            del members[client_id]
+            if not members:
+                self.empty_rooms.add(room_id)
+            room = self.rooms[room_id]
+            room.set_clients(tuple(members.values()))
+            return room
+
+    def pop_empty_rooms(self):
+        #removes and returns the rooms nobody is in
+        with self.lock:
+            rooms = []
+            for room_id in self.empty_rooms:
+                del self.members[room_id]
+                rooms.append(self.rooms.pop(room_id))
+            self.empty_rooms.clear()
+            return rooms
@@ -0,0 +1,132 @@
+import heapq
+import itertools
+import time
+from collections import deque
+from threading import Condition, Thread
+import log
+
+#round timers for all rooms, instead of one threading.Timer (= one OS thread) per room and round
+#every shard is one thread with a heap ordered by due time. everything that is due is fired in one batch.
+#cancel only marks the entry (O(1)), dead entries are skipped when they come up,
+#or thrown out all at once when they are more than half of the heap
+
+JITTER_SAMPLES = 4096  # how many of the last delays we keep for the percentiles
+LATE_WARNING = 1.0  # print a warning when a batch fires this many seconds too late
+
+
+class ScheduledCall:
+    __slots__ = ('due', 'callback', 'args', 'shard', 'cancelled')
+
+    def __init__(self, due, callback, args, shard):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.shard = shard
+        self.cancelled = False
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.shard.cancelled_one()
+
+
+class TimerShard(Thread):
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.condition = Condition()
+        self.heap = []  # (due, sequence, ScheduledCall)
+        self.sequence = itertools.count()  # keeps the order of calls with the same due time
+        self.cancelled = 0
+        self.running = True
+        self.fired = 0
+        self.max_jitter = 0.0
+        self.jitter = deque(maxlen=JITTER_SAMPLES)
+        self.start()
+
+    def call_at(self, due, callback, *args):
+        call = ScheduledCall(due, callback, args, self)
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.sequence), call))
+            #only wake the thread up if the new call is the next one
+            if self.heap[0][2] is call:
+                self.condition.notify()
+        return call
+
+    def cancelled_one(self):
+        with self.condition:
+            self.cancelled += 1
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                        self.cancelled -= 1
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                now = time.monotonic()
+                batch = []
+                while self.heap and self.heap[0][0] <= now:
+                    call = heapq.heappop(self.heap)[2]
+                    if call.cancelled:
+                        self.cancelled -= 1
+                    else:
+                        call.cancelled = True  # fired calls can't be cancelled anymore
+                        batch.append(call)
+
+            #the callbacks run without the lock, they are allowed to schedule again
+            late = 0.0
+            for call in batch:
+                jitter = time.monotonic() - call.due
+                self.jitter.append(jitter)
+                self.max_jitter = max(self.max_jitter, jitter)
+                late = max(late, jitter)
+                try:
+                    call.callback(*call.args)
+                except Exception as e:
+                    log.error('timer_failed', shard=self.name, error=e)
+            self.fired += len(batch)
+            if late > LATE_WARNING:
+                log.warning('timers_late', shard=self.name, calls=len(batch), late_s=late)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+
+class Scheduler:
+    def __init__(self, shards=1):
+        self.shards = [TimerShard(f"scheduler-{number}") for number in range(shards)]
+
+    def call_later(self, delay, callback, *args, key=None):
+        #calls with the same key always go to the same shard (and so are fired in order)
+        shard = self.shards[hash(key) % len(self.shards)]
+        return shard.call_at(time.monotonic() + delay, callback, *args)
+
+    def stats(self):
+        #how late the calls fired (scheduling jitter), in milliseconds
+        jitter = sorted(sample for shard in self.shards for sample in list(shard.jitter))
+
+        def at(p):
+            return jitter[min(int(len(jitter) * p), len(jitter) - 1)] * 1000 if jitter else 0.0
+        return {
+            'pending': sum(len(shard.heap) - shard.cancelled for shard in self.shards),
+            'fired': sum(shard.fired for shard in self.shards),
+            'jitter_p50_ms': at(0.5),
+            'jitter_p99_ms': at(0.99),
+            'jitter_max_ms': max(shard.max_jitter for shard in self.shards) * 1000,
+        }
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
@@ -0,0 +1,120 @@
+import struct
+
+#stroke deltas: instead of a whole png we send the lines that were drawn
+#a batch is a sequence of polylines, each one is
+#  [r][g][b][width][point count: uint16] + count * [x: int16][y: int16]
+#batches can simply be concatenated, the result is a valid batch again
+
+LINE_HEADER = struct.Struct('!BBBBH')
+POINT = struct.Struct('!hh')
+MAX_POINTS = 0xFFFF
+MAX_HISTORY_BYTES = 256 * 1024  # more than this per round and we fall back to a full png
+
+
+class StrokeError(Exception):
+    pass
+
+
+def parse_color(color):
+    #'#rrggbb' -> (r, g, b)
+    value = int(color.lstrip('#'), 16)
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+
+def format_color(r, g, b):
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+class StrokeLog:
+    #collects the segments from mouseMoveEvent and packs them into one batch
+    def __init__(self):
+        self.lines = []  # [(r, g, b), width, [x0, y0, x1, y1, ...]]
+
+    def add_segment(self, x1, y1, x2, y2, color, width):
+        rgb = parse_color(color)
+        if self.lines:
+            last = self.lines[-1]
+            points = last[2]
+            #the mouse keeps moving: just extend the current polyline
+            if (last[0] == rgb and last[1] == width and points[-2] == x1 and points[-1] == y1
+                    and len(points) // 2 < MAX_POINTS):
+                points += (x2, y2)
+                return
+        self.lines.append((rgb, width, [x1, y1, x2, y2]))
+
+    def is_empty(self):
+        return not self.lines
+
+    def clear(self):
+        self.lines = []
+
+    def flush(self):
+        #packs everything collected so far and starts a new batch
+        out = bytearray()
+        for (r, g, b), width, points in self.lines:
+            count = len(points) // 2
+            out += LINE_HEADER.pack(r, g, b, width, count)
+            out += struct.pack(f'!{len(points)}h', *points)
+        self.lines = []
+        return bytes(out)
+
+
+def iter_lines(data):
+    #yields (color, width, points) for every polyline in a batch, checks the bounds
+    pos = 0
+    total = len(data)
+    while pos < total:
+        if pos + LINE_HEADER.size > total:
+            raise StrokeError("Truncated stroke header")
+        r, g, b, width, count = LINE_HEADER.unpack_from(data, pos)
+        pos += LINE_HEADER.size
+        end = pos + count * POINT.size
+        if end > total:
+            raise StrokeError("Truncated stroke points")
+        yield format_color(r, g, b), width, struct.unpack_from(f'!{count * 2}h', data, pos)
+        pos = end
+
+
+def iter_segments(data):
+    #yields (x1, y1, x2, y2, color, width), ready for QPainter.drawLine
+    for color, width, points in iter_lines(data):
+        for i in range(0, len(points) - 2, 2):
+            yield points[i], points[i + 1], points[i + 2], points[i + 3], color, width
+
+
+def validate(data):
+    #walks the whole batch so broken data never gets forwarded to other players
+    for _ in iter_lines(data):
+        pass
+
+
+class StrokeHistory:
+    #server side: the batches a player sent during the current round
+    def __init__(self, max_bytes=MAX_HISTORY_BYTES):
+        self.max_bytes = max_bytes
+        self.batches = []
+        self.bytes = 0
+        self.overflowed = False
+
+    def add(self, batch):
+        if self.overflowed:
+            return
+        if self.bytes + len(batch) > self.max_bytes:
+            #too much drawing for deltas, this round will go out as a png
+            self.overflowed = True
+            self.batches = []
+            self.bytes = 0
+            return
+        self.batches.append(batch)
+        self.bytes += len(batch)
+
+    def accepted(self):
+        return len(self.batches)
+
+    def joined(self):
+        return b''.join(self.batches)
+
+    def reset(self):
+        self.batches = []
+        self.bytes = 0
+        self.overflowed = False
@@ -0,0 +1,168 @@
+import hashlib
+import struct
+import zlib
+
+#canvas sync with tiles: the canvas is cut into 64x64 tiles, the client only sends the tiles
+#that changed since a base drawing the server also has (its last upload or the drawing it got
+#in the exchange), the server puts them on top of the base and makes the png for the exchange.
+#
+#payload = [width: uint16][height: uint16][tile size: uint16] + zlib([index: uint16][rgb pixels] ...)
+#the pngs written here are never filtered, so the server can read them back without a png library
+
+TILE_SIZE = 64
+CANVAS_WIDTH = CANVAS_HEIGHT = 600  # the game canvas, the only size a client may send tiles for
+MAX_SIDE = 4096
+HEADER = struct.Struct('!HHH')
+TILE_INDEX = struct.Struct('!H')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IHDR = struct.Struct('!IIBBBBB')
+COMPRESS_LEVEL = 6
+HASH_SIZE = 8
+
+_blank_hashes = {}  # (width, height, tile size) -> hashes of a white canvas
+
+
+class TileError(Exception):
+    pass
+
+
+def blank(width, height):
+    #white rgb canvas, what a new client starts with
+    return bytearray(b'\xff' * (width * height * 3))
+
+
+def tile_rects(width, height, size=TILE_SIZE):
+    #yields (index, x, y, w, h), the tiles on the right / bottom edge can be smaller
+    index = 0
+    for y in range(0, height, size):
+        for x in range(0, width, size):
+            yield index, x, y, min(size, width - x), min(size, height - y)
+            index += 1
+
+
+def tile_bytes(raw, stride, x, y, w, h):
+    return b''.join(raw[row * stride + x * 3:row * stride + (x + w) * 3] for row in range(y, y + h))
+
+
+def tile_hashes(raw, width, height, stride, size=TILE_SIZE):
+    return [hashlib.blake2b(tile_bytes(raw, stride, x, y, w, h), digest_size=HASH_SIZE).digest()
+            for _, x, y, w, h in tile_rects(width, height, size)]
+
+
+def blank_hashes(width, height, size=TILE_SIZE):
+    key = (width, height, size)
+    if key not in _blank_hashes:
+        _blank_hashes[key] = tile_hashes(blank(width, height), width, height, width * 3, size)
+    return _blank_hashes[key]
+
+
+def pack_changed(raw, width, height, stride, base_hashes=None, size=TILE_SIZE):
+    #client side: returns (payload, hashes, changed tile count), base_hashes None = white canvas
+    if base_hashes is None:
+        base_hashes = blank_hashes(width, height, size)
+    hashes = tile_hashes(raw, width, height, stride, size)
+    body = bytearray()
+    changed = 0
+    for index, x, y, w, h in tile_rects(width, height, size):
+        if index >= len(base_hashes) or hashes[index] != base_hashes[index]:
+            body += TILE_INDEX.pack(index)
+            body += tile_bytes(raw, stride, x, y, w, h)
+            changed += 1
+    return HEADER.pack(width, height, size) + zlib.compress(body, COMPRESS_LEVEL), hashes, changed
+
+
+def apply_tiles(base_png, payload):
+    #server side: base png (None = white canvas) + changed tiles -> png of the new canvas
+    if len(payload) < HEADER.size:
+        raise TileError("Truncated tile header")
+    width, height, size = HEADER.unpack_from(payload)
+    #the header comes from the client: checked before anything is allocated for it
+    if (width, height, size) != (CANVAS_WIDTH, CANVAS_HEIGHT, TILE_SIZE):
+        raise TileError("Bad canvas size")
+    rects = list(tile_rects(width, height, size))
+    #never inflate more than a full canvas plus the indexes (zip bomb)
+    limit = width * height * 3 + len(rects) * TILE_INDEX.size
+    try:
+        inflater = zlib.decompressobj()
+        body = inflater.decompress(payload[HEADER.size:], limit)
+    except zlib.error as e:
+        raise TileError(f"Bad tile data: {e}")
+    if inflater.unconsumed_tail:
+        raise TileError("Tile data too big")
+    if not inflater.eof:
+        raise TileError("Truncated tile data")
+
+    if base_png is None:
+        raw = blank(width, height)
+    else:
+        _, _, raw = decode_png(base_png, (width, height))
+
+    stride = width * 3
+    pos = 0
+    while pos < len(body):
+        if pos + TILE_INDEX.size > len(body):
+            raise TileError("Truncated tile index")
+        (index,) = TILE_INDEX.unpack_from(body, pos)
+        pos += TILE_INDEX.size
+        if index >= len(rects):
+            raise TileError("Tile index out of range")
+        _, x, y, w, h = rects[index]
+        row_length = w * 3
+        if pos + row_length * h > len(body):
+            raise TileError("Truncated tile")
+        for row in range(y, y + h):
+            start = row * stride + x * 3
+            raw[start:start + row_length] = body[pos:pos + row_length]
+            pos += row_length
+    return encode_png(width, height, raw)
+
+
+def png_chunk(kind, body):
+    return struct.pack('!I', len(body)) + kind + body + struct.pack('!I', zlib.crc32(kind + body))
+
+
+def encode_png(width, height, raw):
+    #8 bit rgb, every row with filter 0
+    stride = width * 3
+    rows = b''.join(b'\x00' + raw[y * stride:(y + 1) * stride] for y in range(height))
+    return (PNG_SIGNATURE + png_chunk(b'IHDR', IHDR.pack(width, height, 8, 2, 0, 0, 0))
+            + png_chunk(b'IDAT', zlib.compress(rows, COMPRESS_LEVEL)) + png_chunk(b'IEND', b''))
+
+
+def decode_png(data, expected=None):
+    #reads back what encode_png wrote (any other png raises TileError), returns (width, height, raw).
+    #expected = (width, height) the png must have, checked before inflating
+    if data[:8] != PNG_SIGNATURE:
+        raise TileError("Not a png")
+    pos = 8
+    header = None
+    idat = []
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack_from('!I4s', data, pos)
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if kind == b'IHDR' and len(body) == IHDR.size:
+            header = IHDR.unpack(body)
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+    if header is None or header[2:] != (8, 2, 0, 0, 0):
+        raise TileError("Only 8 bit rgb pngs can be a tile base")
+    width, height = header[:2]
+    if not 0 < width <= MAX_SIDE or not 0 < height <= MAX_SIDE:
+        raise TileError("Bad canvas size")
+    if expected is not None and (width, height) != expected:
+        raise TileError("Canvas size changed")
+    stride = width * 3
+    try:
+        inflater = zlib.decompressobj()
+        rows = inflater.decompress(b''.join(idat), (stride + 1) * height)
+    except zlib.error as e:
+        raise TileError(f"Bad png data: {e}")
+    if len(rows) != (stride + 1) * height or rows[::stride + 1] != bytes(height):
+        raise TileError("Only unfiltered pngs can be a tile base")
+    raw = bytearray(stride * height)
+    for y in range(height):
+        raw[y * stride:(y + 1) * stride] = rows[y * (stride + 1) + 1:(y + 1) * (stride + 1)]
+    return width, height, raw